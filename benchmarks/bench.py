@@ -0,0 +1,225 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import tracemalloc
+import contextlib
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASEPATH, '..'))
+for folder in ('xiaomi', 'openweather', 'breitbandmessung/src'):
+    sys.path.insert(0, os.path.join(BASEPATH, '..', folder))
+
+import fake_servers
+
+# the report always goes to the terminal, even while the collectors' output is hidden
+OUT = sys.stdout
+
+# end-to-end benchmark of the collectors against local stand-ins: a fake influxdb,
+# a fake openweathermap replaying fixtures/ and a fake gatttool in fake_sensor/.
+# every collector is run stage by stage (fetch, parse, encode, write) and once through
+# its normal entry point, the second run is repeated under tracemalloc for the peak memory
+
+class Stages:
+    def __init__(self):
+        self.durations = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+
+def quiet(verbose):
+    # the collectors print every reading, keep the report readable
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+def influx_stats(port):
+    with urllib.request.urlopen('http://127.0.0.1:{}/stats'.format(port)) as response:
+        return json.load(response)
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+class NoPointsWritten(Exception):
+    pass
+
+def report(name, stages, points, total, peak):
+    # an end-to-end run without points only measured a failure, its numbers are worthless
+    if not points:
+        raise NoPointsWritten('{}: the end-to-end run wrote no points to the fake influxdb'.format(name))
+    print(name, file=OUT)
+    for stage, duration in stages.durations.items():
+        print('  {:<10} {:>10.1f} ms'.format(stage, duration * 1000), file=OUT)
+    print('  {:<10} {:>10.1f} ms {:>10.0f} points/s {:>8} points {:>10.1f} KiB peak'.format(
+        'end-to-end', total * 1000, points / max(total, 1e-9), points, peak / 1024), file=OUT)
+
+def bench_xiaomi(args, tmp):
+    xiaomi = importlib.import_module('read_Mi_Temp_Humid')
+    from csv_sink import RotatingCsvSink
+    from common.influx_writer import InfluxWriter
+    from common.influx_client import client_from_env
+    # the fake sensor replaces gatttool, so bluepy must not be used
+    xiaomi.lywsd03mmc.btle = None
+    sensors = [{'name': 'Sensor {}'.format(i), 'mac': 'A4:C1:38:{:02X}:{:02X}:{:02X}'.format(i >> 16 & 255, i >> 8 & 255, i & 255)}
+               for i in range(args.sensors)]
+
+    stages = Stages()
+    writer = InfluxWriter(client_from_env)
+    with stages.stage('fetch'):
+        with ThreadPoolExecutor(max_workers=args.max_connections) as executor:
+            raw = list(executor.map(xiaomi.read_reading, sensors))
+    with stages.stage('parse'):
+        readings = [r for r in (xiaomi.SensorReading(*values) for values in raw) if r.is_valid()]
+    with stages.stage('encode'):
+        writer.add_lines([reading.to_line() for reading in readings])
+    with stages.stage('write'):
+        writer.flush()
+
+    def run():
+        xiaomi.SINK = RotatingCsvSink(os.path.join(tmp, 'temperature.csv'), 'timestamp, location, temperature, humidity, battery')
+        xiaomi.WRITER = InfluxWriter(client_from_env)
+        xiaomi.poll_sensors(sensors, args.max_connections)
+        xiaomi.SINK.close()
+        return xiaomi.WRITER.flush()
+
+    start = time.perf_counter()
+    points = run()
+    total = time.perf_counter() - start
+    report('xiaomi: {} sensors, {} connections'.format(args.sensors, args.max_connections), stages, points, total, peak_memory(run))
+
+def bench_openweather(args, tmp, port):
+    openweather = importlib.import_module('openweather')
+    from common.influx_writer import InfluxWriter
+    from common.influx_client import client_from_env
+    openweather.API_BASE_URL = 'http://127.0.0.1:{}/data/2.5/'.format(port)
+    openweather.CACHE = None
+    locations = [{'name': 'Location {}'.format(i), 'lat': '{:.2f}'.format(47 + i % 8), 'lon': '{:.2f}'.format(6 + i % 9)}
+                 for i in range(args.locations)]
+    report_type = openweather.forecast_report_type(args.numdays)
+
+    stages = Stages()
+    writer = InfluxWriter(client_from_env)
+    with stages.stage('fetch'):
+        calls = {}
+        for i, location in enumerate(locations):
+            calls[('current', i)] = (openweather.fetch_json, openweather.current_url(location), 0)
+            calls[('forecast', i)] = (openweather.fetch_json, openweather.forecast_url(location, args.numdays), 0)
+        responses = openweather.fetch_all(calls, parallel=True)
+    with stages.stage('parse'):
+        reports = []
+        for i, location in enumerate(locations):
+            reports.append(openweather.parse_current(responses[('current', i)], location))
+            reports += openweather.parse_forecast(responses[('forecast', i)], location, report_type)
+    with stages.stage('encode'):
+        writer.add_lines([report.to_line() for report in reports])
+    with stages.stage('write'):
+        writer.flush()
+
+    def run():
+        writer = InfluxWriter(client_from_env)
+        openweather.collect(current=True, daily=True, forecast=True, numdays=args.numdays, writer=writer, locations=locations)
+        return openweather.write_reports(writer)
+
+    start = time.perf_counter()
+    points = run()
+    total = time.perf_counter() - start
+    report('openweather: {} locations, {} days'.format(args.locations, args.numdays), stages, points, total, peak_memory(run))
+
+def write_exports(directory, count, rows):
+    header = 'Messzeitpunkt;Uhrzeit;Download (Mbit/s);Upload (Mbit/s);Laufzeit (ms);Test-ID;Version;Betriebssystem;Internet-Browser\n'
+    for i in range(count):
+        with open(os.path.join(directory, 'Breitbandmessung_{:05d}.csv'.format(i)), 'w', encoding='utf-8-sig') as f:
+            f.write(header)
+            for j in range(rows):
+                n = i * rows + j
+                f.write('{:02d}.{:02d}.2023;{:02d}:{:02d}:00;{},{:02d};{},{:02d};{};{:012d};3.5.0;Linux;Firefox 118\n'.format(
+                    n % 28 + 1, n // 28 % 12 + 1, n % 24, n % 60, 80 + n % 40, n % 100, 30 + n % 10, n % 100, 20 + n % 30, n))
+
+def bench_breitbandmessung(args, tmp):
+    breitbandmessung = importlib.import_module('breitbandmessung')
+    export_dir = os.path.join(tmp, 'export')
+    os.makedirs(export_dir, exist_ok=True)
+    breitbandmessung.EXPORT_DIR = export_dir
+    breitbandmessung.EXPORT_FILES = os.path.join(export_dir, 'Breitbandmessung_*.csv')
+    breitbandmessung.DATA_CSV = os.path.join(export_dir, 'data.csv')
+    breitbandmessung.KNOWN_IDS = os.path.join(export_dir, 'data.ids')
+    files = [os.path.join(export_dir, 'Breitbandmessung_{:05d}.csv'.format(i)) for i in range(args.exports)]
+
+    stages = Stages()
+    write_exports(export_dir, args.exports, args.rows)
+    with stages.stage('parse'):
+        df = breitbandmessung.read_exports(files)
+    with stages.stage('write'):
+        df.to_csv(os.path.join(tmp, 'parsed.csv'), index=False)
+
+    def run():
+        # handle_data removes the exports it has read, start from an empty data.csv every time
+        for path in (breitbandmessung.DATA_CSV, breitbandmessung.KNOWN_IDS):
+            if os.path.exists(path):
+                os.remove(path)
+        write_exports(export_dir, args.exports, args.rows)
+        start = time.perf_counter()
+        breitbandmessung.handle_data()
+        return time.perf_counter() - start
+
+    total = run()
+    report('breitbandmessung: {} exports x {} rows'.format(args.exports, args.rows), stages, len(df), total, peak_memory(run))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the collectors against a fake influxdb, openweathermap and sensors')
+    parser.add_argument('--only', choices=['xiaomi', 'openweather', 'breitbandmessung'], action='append', help='run only these collectors')
+    parser.add_argument('--sensors', type=int, default=10, help='number of fake sensors')
+    parser.add_argument('-j', '--max-connections', type=int, default=3, help='sensors polled at the same time')
+    parser.add_argument('--sensor-delay', type=float, default=0.5, help='seconds a fake sensor takes to answer')
+    parser.add_argument('--locations', type=int, default=5, help='number of weather locations')
+    parser.add_argument('-n', '--numdays', type=int, default=7, help='days per forecast request')
+    parser.add_argument('--api-delay', type=float, default=0.05, help='seconds the fake openweathermap takes to answer')
+    parser.add_argument('--exports', type=int, default=20, help='number of breitbandmessung export files')
+    parser.add_argument('--rows', type=int, default=50, help='rows per export file')
+    parser.add_argument('--influx-delay', type=float, default=0, help='seconds the fake influxdb takes per write')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the output of the collectors')
+    args = parser.parse_args()
+    collectors = args.only or ['xiaomi', 'openweather', 'breitbandmessung']
+
+    influx, influx_port = fake_servers.start(fake_servers.FakeInfluxDB, args.influx_delay)
+    api, api_port = fake_servers.start(fake_servers.FakeOpenWeather, args.api_delay)
+    tmp = tempfile.mkdtemp(prefix='homeserver-bench-')
+    # the collectors read their configuration when they are imported
+    os.environ.update(INFLUXDB_HOST='127.0.0.1', INFLUXDB_PORT=str(influx_port), INFLUXDB_DATABASE='bench',
+                      INFLUXDB_USER='', INFLUXDB_PASSWORD='', API_KEY='bench', CACHE_DIR=os.path.join(tmp, 'cache'),
+                      FAKE_SENSOR_DELAY=str(args.sensor_delay),
+                      PATH=os.path.join(BASEPATH, 'fake_sensor') + os.pathsep + os.environ.get('PATH', ''))
+    try:
+        for name in collectors:
+            with quiet(args.verbose):
+                if name == 'xiaomi':
+                    bench_xiaomi(args, tmp)
+                elif name == 'openweather':
+                    bench_openweather(args, tmp, api_port)
+                else:
+                    bench_breitbandmessung(args, tmp)
+        stats = influx_stats(influx_port)
+        print('fake influxdb received {} points in {} writes ({:.1f} KiB)'.format(
+            stats['points'], stats['writes'], stats['bytes'] / 1024))
+    except NoPointsWritten as e:
+        print('Error: {}, run with -v to see the output of the collector'.format(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+        influx.terminate()
+        api.terminate()
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASEPATH, '..'))
+sys.path.insert(0, os.path.join(BASEPATH, '../xiaomi'))
+sys.path.insert(0, os.path.join(BASEPATH, '../openweather'))
+
+from influxdb.line_protocol import make_lines
+from common.line_protocol import encode_batch
+from read_Mi_Temp_Humid import SensorReading
+from openweather import WeatherReport, ReportType
+
+# compares the old write_points path (dict points serialized by make_lines)
+# with the precompiled line protocol encoder used by the writer
+
+def sensor_readings(n):
+    start = datetime(2023, 1, 1)
+    readings = []
+    for i in range(n):
+        reading = SensorReading('Room {}'.format(i % 10), 20 + (i % 50) / 10, 40 + i % 20, 2.9)
+        reading.timestamp = start + timedelta(minutes=10 * i)
+        readings.append(reading)
+    return readings
+
+def weather_reports(n):
+    reports = []
+    for i in range(n):
+        report = WeatherReport(ReportType.FORECAST)
+        report.location = 'Berlin'
+        report.data = {'date': '2023-01-{:02d}'.format(i % 28 + 1), 'sunrise': '08:15:00', 'sunset': '16:02:00',
+                       'weather': 'Rain', 'weather description': 'leichter Regen', 'weather icon': '10d',
+                       'temp morning': 2.5, 'felt temp morning': -0.4, 'temp day': 5.1, 'felt temp day': 2.2,
+                       'temp evening': 3.9, 'felt temp evening': 1.0, 'temp night': 1.2, 'felt temp night': -1.9,
+                       'temp min': 0.8, 'temp max': 5.6, 'pressure': 1012, 'humidity': 87, 'cloud coverage': 100,
+                       'wind speed': 4.6, 'wind deg': 240, 'wind gust': 9.8, 'pop': 80, 'rain volume': 2.3}
+        reports.append(report)
+    return reports
+
+def measure(name, func, objects, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(objects)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    tracemalloc.start()
+    func(objects)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<32} {:>10.2f} us/point {:>10.0f} points/s {:>8.0f} bytes/point peak'.format(
+        name, best / len(objects) * 1e6, len(objects) / best, peak / len(objects)))
+
+def dict_path(objects):
+    return make_lines({'points': [o.to_point() for o in objects]}).encode('utf-8')
+
+def line_path(objects):
+    return encode_batch([o.to_line() for o in objects])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the write_points dict path with the line protocol encoder')
+    parser.add_argument('-n', '--points', type=int, default=10000, help='number of points per run')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per measurement, the best one is reported')
+    args = parser.parse_args()
+
+    for kind, objects in (('temp_sensor', sensor_readings(args.points)), ('forecast_weather', weather_reports(args.points))):
+        print('{} x {}'.format(kind, args.points))
+        measure('  write_points dicts', dict_path, objects, args.repeat)
+        measure('  line protocol encoder', line_path, objects, args.repeat)
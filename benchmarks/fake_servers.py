@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import date
+from urllib.parse import urlparse, parse_qs
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(BASEPATH, 'fixtures')
+
+# local stand-ins for influxdb and openweathermap, so the collectors can be benchmarked
+# without touching the real database or the api quota. both run in their own process,
+# the benchmark only measures the client side
+
+class FakeInfluxDB(BaseHTTPRequestHandler):
+    # answers /ping, /query and /write like influxdb 1.x and counts what was written
+    protocol_version = 'HTTP/1.1'
+    stats = {'writes': 0, 'points': 0, 'bytes': 0}
+    lock = threading.Lock()
+    delay = 0
+    # InfluxDBClient.ping() returns this header and fails without it
+    version = '1.8.10'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b'', content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('X-Influxdb-Version', self.version)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/ping':
+            self.reply(204)
+        elif path == '/query':
+            self.reply(200, json.dumps({'results': [{'statement_id': 0}]}).encode('utf-8'))
+        elif path == '/stats':
+            with self.lock:
+                self.reply(200, json.dumps(self.stats).encode('utf-8'))
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path == '/write':
+            time.sleep(self.delay)
+            with self.lock:
+                self.stats['writes'] += 1
+                self.stats['points'] += body.count(b'\n') + (0 if body.endswith(b'\n') or not body else 1)
+                self.stats['bytes'] += len(body)
+            self.reply(204)
+        elif path == '/query':
+            self.reply(200, json.dumps({'results': [{'statement_id': 0}]}).encode('utf-8'))
+        else:
+            self.reply(404)
+
+def shift_to_today(res, first_dt):
+    # the fixtures were recorded in january 2023, the collectors look for today's date.
+    # moves every timestamp by whole days so the recording starts today
+    shift = (date.today() - date.fromtimestamp(first_dt)).days * 86400
+    for item in res.get('list', [res]):
+        for key in ('dt', 'sunrise', 'sunset'):
+            if key in item:
+                item[key] += shift
+    if 'sys' in res:
+        res['sys'] = {key: value + shift if key in ('sunrise', 'sunset') else value for key, value in res['sys'].items()}
+    return res
+
+class FakeOpenWeather(BaseHTTPRequestHandler):
+    # replays the recorded responses in fixtures/ shifted to today, /forecast/daily is cut to cnt days
+    protocol_version = 'HTTP/1.1'
+    fixtures = {}
+    delay = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        time.sleep(self.delay)
+        if url.path.endswith('/weather'):
+            res = shift_to_today(dict(self.fixtures['current']), self.fixtures['current']['dt'])
+        elif url.path.endswith('/forecast/daily'):
+            res = dict(self.fixtures['forecast_daily'])
+            res['list'] = [dict(item) for item in res['list'][:int(query.get('cnt', ['7'])[0])]]
+            res['cnt'] = len(res['list'])
+            shift_to_today(res, self.fixtures['forecast_daily']['list'][0]['dt'])
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # every location gets its own coordinates back, like the real api
+        if 'lat' in query and 'lon' in query:
+            coord = {'lat': float(query['lat'][0]), 'lon': float(query['lon'][0])}
+            if 'city' in res:
+                res['city'] = dict(res['city'], coord=coord)
+            else:
+                res['coord'] = coord
+        body = json.dumps(res).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def load_fixtures(path=FIXTURES):
+    fixtures = {}
+    for name in ('current', 'forecast_daily'):
+        with open(os.path.join(path, name + '.json'), encoding='utf-8') as f:
+            fixtures[name] = json.load(f)
+    return fixtures
+
+def serve(handler, port=0, ready=None, delay=0):
+    handler.delay = delay
+    if handler is FakeOpenWeather:
+        handler.fixtures = load_fixtures()
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+def start(handler, delay=0):
+    # starts the server in a child process and returns (process, port)
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(handler, 0, ready, delay), daemon=True)
+    process.start()
+    return process, ready.get(timeout=10)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake influxdb or openweathermap server')
+    parser.add_argument('server', choices=['influxdb', 'openweather'])
+    parser.add_argument('-p', '--port', type=int, default=0, help='port to listen on, default: a free one')
+    parser.add_argument('--delay', type=float, default=0, help='seconds to wait before every answer')
+    args = parser.parse_args()
+
+    handler = FakeInfluxDB if args.server == 'influxdb' else FakeOpenWeather
+    ready = multiprocessing.Queue()
+    threading.Thread(target=lambda: print('Listening on 127.0.0.1:{}'.format(ready.get()), flush=True), daemon=True).start()
+    serve(handler, args.port, ready, args.delay)
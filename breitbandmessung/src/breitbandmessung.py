@@ -1,20 +1,151 @@
 import os
+import io
+import sys
+import csv
+import time
 import glob
-import pandas as pd
-from selenium import webdriver
-from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
+import argparse
+from datetime import datetime
 
 from dotenv import load_dotenv
 
+# pandas, selenium and parquet_store (pyarrow) are imported by the functions that use them,
+# `ingest` never loads selenium and neither command pays for the other one's imports
 load_dotenv()
 FIREFOX_EXE = os.getenv('FIREFOX_EXE')
 
-def get_data():
+# paths are relative to this file so the collector daemon can run it from anywhere
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASEPATH, '../..'))
+from common.collector_stats import CollectorStats
+
+# browser start, test and ingest durations, written to data/breitbandmessung.prom
+STATS = CollectorStats('breitbandmessung')
+EXPORT_DIR = os.path.join(BASEPATH, '../export')
+EXPORT_FILES = os.path.join(EXPORT_DIR, 'Breitbandmessung_*.csv')
+DATA_CSV = os.path.join(EXPORT_DIR, 'data.csv')
+PROFILE_DIR = os.getenv('FIREFOX_PROFILE', os.path.join(BASEPATH, '../profile'))
+# Test-IDs already in data.csv, one per line, so new exports can be appended without reading the history
+KNOWN_IDS = os.path.join(EXPORT_DIR, 'data.ids')
+COLUMNS = ["Messzeitpunkt", "Download (Mbit/s)", "Upload (Mbit/s)", "Laufzeit (ms)",
+           "Test-ID", "Version", "Betriebssystem", "Internet-Browser"]
+
+# the results page builds the csv export in the browser and downloads it through a blob/data url.
+# this hook keeps the csv text in window.__bbmExport and skips the file download
+CAPTURE_EXPORT_JS = """
+window.__bbmExport = null;
+const createObjectURL = URL.createObjectURL;
+URL.createObjectURL = function(blob) {
+    if (blob instanceof Blob) {
+        blob.text().then(text => { window.__bbmExport = text; });
+    }
+    return createObjectURL.apply(this, arguments);
+};
+const click = HTMLAnchorElement.prototype.click;
+HTMLAnchorElement.prototype.click = function() {
+    if (this.href.startsWith('data:')) {
+        window.__bbmExport = decodeURIComponent(this.href.substring(this.href.indexOf(',') + 1));
+        return;
+    }
+    if (this.href.startsWith('blob:')) {
+        return;
+    }
+    return click.apply(this, arguments);
+};
+"""
+
+class BrowserSession:
+    # one firefox instance that can be reused for several tests, always quit with close()
+    def __init__(self, headless=True, profile_dir=PROFILE_DIR):
+        self.headless = headless
+        self.profile_dir = profile_dir
+        self._driver = None
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            self._driver = create_driver(self.headless, self.profile_dir)
+        return self._driver
+
+    def measure(self):
+        from selenium.common.exceptions import WebDriverException
+        try:
+            return get_data(self.driver)
+        except WebDriverException as e:
+            # the browser died, start a fresh one for the next test
+            print(f"[error: get data]\t{e}")
+            self.close()
+            return None
+
+    def close(self):
+        from selenium.common.exceptions import WebDriverException
+        if self._driver is not None:
+            try:
+                self._driver.quit()
+            except WebDriverException as e:
+                print(f"[error: get data]\t{e}")
+            self._driver = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+@STATS.timed('browser_start')
+def create_driver(headless=True, profile_dir=PROFILE_DIR):
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+    # check if export folder exists, if not create it
+    if not os.path.exists(EXPORT_DIR):
+        os.makedirs(EXPORT_DIR)
+    download_path = os.path.abspath(EXPORT_DIR)
+
+    options = Options()
+    if headless:
+        options.add_argument('-headless')
+    if FIREFOX_EXE:
+        options.binary_location = FIREFOX_EXE
+    # a persistent profile keeps the cookie consent between runs
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        options.add_argument('-profile')
+        options.add_argument(os.path.abspath(profile_dir))
+    options.set_preference("browser.download.folderList", 2)
+    options.set_preference("browser.download.manager.showWhenStarting", False)
+    options.set_preference("browser.download.dir", download_path)
+
+    driver = webdriver.Firefox(options=options)
+    try:
+        _set_viewport_size(driver, 1920, 1080)
+    except Exception:
+        driver.quit()
+        raise
+    return driver
+
+def get_data(driver=None, headless=True):
+    # returns the result as a record, see parse_export.
+    # without a driver a browser is started for this test only and is always quit afterwards
+    if driver is None:
+        from selenium.common.exceptions import WebDriverException
+        try:
+            with BrowserSession(headless) as session:
+                return get_data(session.driver)
+        except WebDriverException as e:
+            print(f"[error: get data]\t{e}")
+            return None
+
+    with STATS.timer('measure'):
+        record = run_test(driver)
+    if record is None:
+        STATS.fail('measure')
+    return record
+
+def run_test(driver):
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
     # selectors
     stupid_location_selector = '.modal-body'
     decline_cookies_selector = '#allow-necessary'
@@ -22,28 +153,9 @@ def get_data():
     accept_policy_selector = 'button.btn:nth-child(2)'
     download_results_selector = 'button.px-0:nth-child(1)'
 
-    # check if export folder exists, if not create it
-    if not os.path.exists('../export'):
-        os.makedirs('../export')
-    download_path = os.path.abspath('../export')
-
     BASE_URL = 'https://breitbandmessung.de'
     url = BASE_URL + '/test'
 
-    try:
-        binary = FirefoxBinary(FIREFOX_EXE)
-
-        options = Options()
-        #options.headless = True
-        options.set_preference("browser.download.folderList", 2)
-        options.set_preference("browser.download.manager.showWhenStarting", False)
-        options.set_preference("browser.download.dir", download_path)
-
-        driver = webdriver.Firefox(firefox_binary=binary, options=options)
-        _set_viewport_size(driver, 1920, 1080)
-    except Exception as e:
-        print(f"[error: get data]\t{e}")
-
     driver.get(url)
     # wait until the modalbody disappears
     try:
@@ -51,16 +163,15 @@ def get_data():
             EC.invisibility_of_element_located((By.CSS_SELECTOR, stupid_location_selector)))
     except TimeoutException as e:
         print(f"[error: get data]\t{e}")
-        return
+        return None
 
-    # decline cookies
+    # decline cookies, with a persistent profile the banner only shows up on the first run
     try:
-        decline_cookies = WebDriverWait(driver, 10).until(
+        decline_cookies = WebDriverWait(driver, 3).until(
             EC.element_to_be_clickable((By.CSS_SELECTOR, decline_cookies_selector)))
-    except TimeoutException as e:
-        print(f"[error: get data]\t{e}")
-        return
-    decline_cookies.click()
+        decline_cookies.click()
+    except TimeoutException:
+        print(f"[info: get data]\tNo cookie banner")
 
     # wait until the start test button is clickable
     try:
@@ -69,60 +180,191 @@ def get_data():
             EC.element_to_be_clickable((By.CSS_SELECTOR, start_test_selector)))
     except TimeoutException as e:
         print(f"[error: get data]\t{e}")
-        return
+        return None
     start_test.click()
 
     # scroll down to the bottom of the page
     driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
     # wait until the accept policy button is clickable
-    accept_policy = WebDriverWait(driver, 10).until(
-                    EC.element_to_be_clickable((By.CSS_SELECTOR, accept_policy_selector)))
+    try:
+        accept_policy = WebDriverWait(driver, 10).until(
+                        EC.element_to_be_clickable((By.CSS_SELECTOR, accept_policy_selector)))
+    except TimeoutException as e:
+        print(f"[error: get data]\t{e}")
+        return None
     accept_policy.click()
 
     print(f"[info: get data]\tTest started")
 
     # wait until the download results button is clickable and download the results
-    download_results = WebDriverWait(driver, 60).until(
-                    EC.element_to_be_clickable((By.CSS_SELECTOR, download_results_selector)))
+    try:
+        with STATS.timer('speedtest'):
+            download_results = WebDriverWait(driver, 60).until(
+                            EC.element_to_be_clickable((By.CSS_SELECTOR, download_results_selector)))
+    except TimeoutException as e:
+        print(f"[error: get data]\t{e}")
+        return None
     print(f"[info: get data]\tTest finished")
+    driver.execute_script(CAPTURE_EXPORT_JS)
     download_results.click()
-    print(f"[info: get data]\tdownloaded result to {download_path}")
-    driver.close()
+    try:
+        export = WebDriverWait(driver, 10).until(lambda d: d.execute_script("return window.__bbmExport;"))
+    except TimeoutException:
+        print(f"[error: get data]\tCould not capture the result, it may have been downloaded to {EXPORT_DIR}")
+        return None
+    try:
+        records = parse_export(export)
+    except (KeyError, ValueError) as e:
+        # a changed or broken export must not end the other runs
+        print(f"[error: get data]\tCould not parse export ({e!r}): {export}")
+        return None
+    if not records:
+        print(f"[error: get data]\tNo result in export: {export}")
+        return None
+    print(f"[info: get data]\tGot result {records[-1]['Test-ID']}: {records[-1]['Download (Mbit/s)']} / {records[-1]['Upload (Mbit/s)']} Mbit/s")
+    return records[-1]
+
+def parse_export(text):
+    # parse the csv export (';' separated, german decimals) into records with proper types
+    records = []
+    for row in csv.DictReader(io.StringIO(text.lstrip('\ufeff')), delimiter=';'):
+        record = {k.strip(): (v or '').strip() for k, v in row.items() if k}
+        record['Messzeitpunkt'] = datetime.strptime(f"{record['Messzeitpunkt']} {record.pop('Uhrzeit')}", '%d.%m.%Y %H:%M:%S')
+        record['Download (Mbit/s)'] = float(record['Download (Mbit/s)'].replace(',', '.'))
+        record['Upload (Mbit/s)'] = float(record['Upload (Mbit/s)'].replace(',', '.'))
+        record['Laufzeit (ms)'] = int(record['Laufzeit (ms)'])
+        records.append(record)
+    return records
+
+def run_scheduled(runs, interval, headless=True, storage='csv'):
+    # several tests in a row with the same browser, interval in minutes between the starts
+    with BrowserSession(headless) as session:
+        for run in range(runs):
+            start = time.monotonic()
+            record = session.measure()
+            handle_data(storage=storage, records=[record] if record else None)
+            STATS.emit()
+            if run < runs - 1:
+                time.sleep(max(0, interval * 60 - (time.monotonic() - start)))
 
-def handle_data():
+# dtypes of the export files, german decimals are handled by read_csv
+EXPORT_DTYPES = {'Messzeitpunkt': str, 'Uhrzeit': str, 'Download (Mbit/s)': float, 'Upload (Mbit/s)': float,
+                 'Laufzeit (ms)': 'Int64', 'Test-ID': str, 'Version': str, 'Betriebssystem': str, 'Internet-Browser': str}
+
+@STATS.timed('parse_exports')
+def read_exports(files):
+    # all files are joined into one buffer per header and parsed with a single read_csv,
+    # the date is parsed once for all rows
+    import pandas as pd
+    start = time.monotonic()
+    buffers = {}
+    for f in files:
+        with open(f, encoding='utf-8-sig') as fh:
+            header = fh.readline()
+            body = fh.read()
+        if body and not body.endswith('\n'):
+            body += '\n'
+        buffers.setdefault(header, [header]).append(body)
+    df = pd.concat([pd.read_csv(io.StringIO(''.join(chunks)), delimiter=';', decimal=',', dtype=EXPORT_DTYPES)
+                    for chunks in buffers.values()], ignore_index=True)
+    # fix dtypes, format date
+    df['Messzeitpunkt'] = pd.to_datetime(df['Messzeitpunkt'] + ' ' + df['Uhrzeit'], format='%d.%m.%Y %H:%M:%S')
+    df.drop(columns=['Uhrzeit'], inplace=True)
+    duration = time.monotonic() - start
+    print(f"[info: handle data]\tParsed {len(df)} rows from {len(files)} files in {duration:.2f}s ({len(df) / max(duration, 1e-6):.0f} rows/s)")
+    return df
+
+def load_known_ids(path=KNOWN_IDS, read_ids=None):
+    if os.path.exists(path):
+        with open(path) as f:
+            return set(line.strip() for line in f if line.strip())
+    # first run in append mode, build the index once from the stored data
+    if read_ids is None:
+        read_ids = _read_csv_ids
+    ids = read_ids()
+    if ids:
+        print(f"[info: handle data]\tBuilding {path} with {len(ids)} Test-IDs")
+    with open(path, 'w') as f:
+        f.writelines(f"{i}\n" for i in ids)
+    return ids
+
+def _read_csv_ids():
+    import pandas as pd
+    if not os.path.exists(DATA_CSV):
+        return set()
+    # read as str, inferred as int zero padded IDs would lose their zeros
+    return set(pd.read_csv(DATA_CSV, usecols=['Test-ID'], dtype={'Test-ID': str})['Test-ID'])
+
+def collect_results(records):
+    # results from get_data plus export files that were downloaded manually or by an older version
+    import pandas as pd
+    files = glob.glob(EXPORT_FILES)
+    dfs = [read_exports(files)] if files else []
+    if records:
+        dfs.append(pd.DataFrame(records))
+    return files, dfs
+
+@STATS.timed('handle_data')
+def handle_data(append=True, storage='csv', records=None):
+    import pandas as pd
+    if not append and storage == 'csv':
+        return rewrite_data(records)
+    files, dfs = collect_results(records)
+    if not dfs:
+        return
+    df = pd.concat(dfs)
+    df['Test-ID'] = df['Test-ID'].astype(str)
+    # only append tests we haven't seen yet
+    if storage == 'parquet':
+        import parquet_store
+        ids_path = parquet_store.PARQUET_IDS
+        known = load_known_ids(ids_path, parquet_store.read_ids)
+    else:
+        ids_path = KNOWN_IDS
+        known = load_known_ids(ids_path)
+    df = df[~df['Test-ID'].isin(known)].drop_duplicates(subset=['Test-ID'])
+    if storage == 'parquet':
+        parquet_store.append(df)
+    elif os.path.exists(DATA_CSV):
+        # keep the column order of the existing file
+        columns = list(pd.read_csv(DATA_CSV, nrows=0).columns)
+        df.reindex(columns=columns).to_csv(DATA_CSV, mode='a', header=False, index=False)
+    else:
+        df.reindex(columns=COLUMNS).to_csv(DATA_CSV, index=False)
+    with open(ids_path, 'a') as f:
+        f.writelines(f"{i}\n" for i in df['Test-ID'])
+    STATS.count('export_files', len(files))
+    STATS.count('rows_appended', len(df))
+    print(f"[info: handle data]\tRead {len(files)} files and {len(records or [])} results, appended {len(df)} new rows to {storage} output.")
+    # remove all files in ./export that have been read
+    for f in files:
+        os.remove(f)
+
+def rewrite_data(records=None):
+    import pandas as pd
     # check if data.csv exists
     try:
-        df = pd.read_csv('../export/data.csv')
+        df = pd.read_csv(DATA_CSV, dtype={'Test-ID': str})
     except FileNotFoundError:
         print("[error: handle data]\tNo data.csv found, creating it...")
-        cols = ["Messzeitpunkt", "Download (Mbit/s)", "Upload (Mbit/s)", "Laufzeit (ms)",
-                "Test-ID", "Version", "Betriebssystem", "Internet-Browser"]
-        df = pd.DataFrame(columns=cols)
-        df.to_csv('../export/data.csv', index=False)
-    # get files in ../export
-    files = glob.glob('../export/Breitbandmessung_*.csv')
-    if not files:
+        df = pd.DataFrame(columns=COLUMNS)
+        df.to_csv(DATA_CSV, index=False)
+    files, dfs = collect_results(records)
+    if not dfs:
         return
-    # read all files
-    dfs = [pd.read_csv(f, delimiter=";") for f in files]
-    # fix dtypes, format date and Mbit/s to be float
-    for df in dfs:
-        df['Messzeitpunkt_formatted'] = df['Messzeitpunkt'].astype(str) + ' ' + df['Uhrzeit'].astype(str)
-        df['Messzeitpunkt'] = pd.to_datetime(df['Messzeitpunkt_formatted'], format='%d.%m.%Y %H:%M:%S')
-        df['Download (Mbit/s)'] = df['Download (Mbit/s)'].str.replace(',', '.').astype(float)
-        df['Upload (Mbit/s)'] = df['Upload (Mbit/s)'].str.replace(',', '.').astype(float)
-        df.drop(columns=['Uhrzeit', 'Messzeitpunkt_formatted'], inplace=True)
     # concat all files to the existing file
+    # Test-IDs are strings everywhere, as ints they wouldn't match the new results
     try:
-        existing = pd.read_csv('../export/data.csv')
+        existing = pd.read_csv(DATA_CSV, dtype={'Test-ID': str})
     except FileNotFoundError:
-        cols = ["Messzeitpunkt", "Download (Mbit/s)", "Upload (Mbit/s)", "Laufzeit (ms)",
-                "Test-ID", "Version", "Betriebssystem", "Internet-Browser"]
-        existing = pd.DataFrame(columns=cols)
+        existing = pd.DataFrame(columns=COLUMNS)
     df = pd.concat([existing, *dfs])
     df.drop_duplicates(subset=['Test-ID'], inplace=True)
-    df.to_csv('../export/data.csv', index=False)
-    print(f"[info: handle data]\tRead {len(dfs)} files, wrote {len(df)} rows to output.")
+    df.to_csv(DATA_CSV, index=False)
+    # the full rewrite invalidates the append index, it is rebuilt on the next append
+    if os.path.exists(KNOWN_IDS):
+        os.remove(KNOWN_IDS)
+    print(f"[info: handle data]\tRead {len(files)} files and {len(records or [])} results, wrote {len(df)} rows to output.")
     # remove all files in ./export that have been read
     for f in files:
         os.remove(f)
@@ -134,6 +376,45 @@ def _set_viewport_size(driver, width, height):
         """, width, height)
     driver.set_window_size(*window_size)
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run a speedtest on breitbandmessung.de and collect the results')
+    commands = parser.add_subparsers(dest='command')
+    shared = argparse.ArgumentParser(add_help=False)
+    shared.add_argument('--rewrite', action='store_true', help='rewrite the whole data.csv instead of appending new results')
+    shared.add_argument('--storage', choices=['csv', 'parquet'], default='csv', help='where to store the results')
+    shared.add_argument('--profile-startup', action='store_true', help='show what the imports of this command cost and exit')
+    measure = commands.add_parser('measure', parents=[shared], help='run a speedtest and store the result (default)')
+    measure.add_argument('--headed', action='store_true', help='show the browser window')
+    measure.add_argument('--runs', type=int, default=1, help='number of tests to run with the same browser')
+    measure.add_argument('--interval', type=float, default=60, help='minutes between the tests with --runs')
+    ingest = commands.add_parser('ingest', parents=[shared], help='store the export files in ../export without starting a browser')
+    ingest.add_argument('--migrate-parquet', action='store_true', help='copy the existing data.csv to the parquet storage and exit')
+    # without a command it runs a test like before, --migrate-parquet alone still works
+    if not argv or argv[0] not in ('measure', 'ingest', '-h', '--help'):
+        argv = ['ingest' if '--migrate-parquet' in argv else 'measure', *argv]
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
-    get_data()
-    handle_data()
+    args = parse_args(sys.argv[1:])
+
+    if args.profile_startup:
+        from common import startup_profile
+        extra = ['pandas'] + (['pyarrow'] if args.storage == 'parquet' else [])
+        if args.command == 'measure':
+            extra.append('selenium.webdriver')
+        startup_profile.report('breitbandmessung', BASEPATH, extra)
+    elif args.command == 'ingest' and args.migrate_parquet:
+        import parquet_store
+        parquet_store.migrate_csv(DATA_CSV)
+        # the parquet index is rebuilt from the migrated data on the next run
+        if os.path.exists(parquet_store.PARQUET_IDS):
+            os.remove(parquet_store.PARQUET_IDS)
+    elif args.command == 'ingest':
+        handle_data(append=not args.rewrite, storage=args.storage)
+        STATS.emit()
+    elif args.runs > 1:
+        run_scheduled(args.runs, args.interval, not args.headed, args.storage)
+    else:
+        record = get_data(headless=not args.headed)
+        handle_data(append=not args.rewrite, storage=args.storage, records=[record] if record else None)
+        STATS.emit()
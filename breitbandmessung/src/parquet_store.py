@@ -0,0 +1,96 @@
+import os
+import pandas as pd
+
+# parquet support is optional, only needed with --storage parquet
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+PARQUET_DIR = os.path.join(BASEPATH, '../export/parquet')
+# Test-IDs already stored in the parquet dataset, see breitbandmessung.load_known_ids
+PARQUET_IDS = os.path.join(BASEPATH, '../export/parquet.ids')
+
+FLOAT_COLUMNS = ['Download (Mbit/s)', 'Upload (Mbit/s)']
+STRING_COLUMNS = ['Test-ID', 'Version', 'Betriebssystem', 'Internet-Browser']
+# every append adds a file per month, a month with more files than this is rewritten as one
+MAX_FILES = 24
+COMPACTED_FILE = 'compacted.parquet'
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError('the parquet storage needs pyarrow, install it with `pip install pyarrow`')
+
+def normalize(df):
+    # fixed dtypes so nothing has to be re-inferred on read, plus the month partition key
+    df = df.copy()
+    df['Messzeitpunkt'] = pd.to_datetime(df['Messzeitpunkt'])
+    for col in FLOAT_COLUMNS:
+        df[col] = df[col].astype(float)
+    df['Laufzeit (ms)'] = pd.to_numeric(df['Laufzeit (ms)'])
+    for col in STRING_COLUMNS:
+        df[col] = df[col].astype(str)
+    df['month'] = df['Messzeitpunkt'].dt.strftime('%Y-%m')
+    return df
+
+def append(df, root=PARQUET_DIR):
+    # every call adds new files to the month partitions, months with too many files are compacted
+    _require_pyarrow()
+    if df.empty:
+        return 0
+    df = normalize(df)
+    df.to_parquet(root, engine='pyarrow', partition_cols=['month'], index=False)
+    for month in df['month'].unique():
+        compact(os.path.join(root, f"month={month}"))
+    return len(df)
+
+def compact(partition, max_files=MAX_FILES):
+    # rewrite the files of one month as a single file. readers skip files starting with '.',
+    # so the new file only shows up with the rename, and a crash before the old files are
+    # removed only leaves duplicates that the next compaction drops again
+    _require_pyarrow()
+    files = [name for name in os.listdir(partition) if name.endswith('.parquet') and not name.startswith(('.', '_'))]
+    if len(files) <= max_files:
+        return False
+    df = pd.read_parquet(partition, engine='pyarrow')
+    df = df.drop_duplicates(subset=['Test-ID']).sort_values('Messzeitpunkt')
+    tmp_path = os.path.join(partition, '.' + COMPACTED_FILE)
+    df.to_parquet(tmp_path, engine='pyarrow', index=False)
+    os.replace(tmp_path, os.path.join(partition, COMPACTED_FILE))
+    for name in files:
+        if name != COMPACTED_FILE:
+            os.remove(os.path.join(partition, name))
+    print(f"[info: parquet]\tCompacted {len(files)} files in {partition}")
+    return True
+
+def load(root=PARQUET_DIR, start=None, end=None, columns=None):
+    # only the month partitions between start and end are opened, only the requested columns are read
+    _require_pyarrow()
+    if not os.path.exists(root):
+        return pd.DataFrame(columns=columns)
+    filters = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters += [('month', '>=', start.strftime('%Y-%m')), ('Messzeitpunkt', '>=', start)]
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters += [('month', '<=', end.strftime('%Y-%m')), ('Messzeitpunkt', '<=', end)]
+    df = pd.read_parquet(root, engine='pyarrow', columns=columns, filters=filters or None)
+    if 'month' in df.columns:
+        df = df.drop(columns=['month'])
+    return df
+
+def read_ids(root=PARQUET_DIR):
+    return set(load(root, columns=['Test-ID'])['Test-ID'].astype(str))
+
+def migrate_csv(csv_path, root=PARQUET_DIR):
+    # one-shot import of an existing data.csv, refuses to run twice into the same dataset
+    _require_pyarrow()
+    if os.path.exists(root) and os.listdir(root):
+        raise FileExistsError(f"{root} already contains data, remove it to migrate again")
+    df = pd.read_csv(csv_path, dtype={'Test-ID': str})
+    df = df.drop_duplicates(subset=['Test-ID'])
+    written = append(df, root)
+    print(f"[info: migrate]\tWrote {written} rows from {csv_path} to {root}")
+    return written
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import importlib
+import threading
+from datetime import datetime, timedelta
+import dotenv
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+for folder in ('xiaomi', 'openweather', 'breitbandmessung/src'):
+    sys.path.insert(0, os.path.join(BASEPATH, folder))
+
+CONFIG = os.path.join(BASEPATH, 'collector_daemon.json')
+# every collector loads the first .env it finds, in one process that would be the one of
+# whichever module is imported first. the daemon loads this one before any of them
+ENV_FILE = os.path.join(BASEPATH, '.env')
+
+# schedule: {"hours": minutes between runs}, same cadence as the cron lines in the README
+DEFAULT_CONFIG = {
+    'xiaomi': {'schedule': {'6-23': 10, '0-5': 30}},
+}
+
+# the collector modules are imported once and stay loaded, so their influxdb clients
+# and http connection pools are reused between runs
+MODULES = {}
+# the rollup job keeps its own influxdb client
+ROLLUP_CLIENT = None
+# with reuse_browser the speedtests share one firefox that stays open between runs
+BROWSER = None
+# the weather jobs share openweather.STATS and WRITER, one job's emit would report and
+# reset the stats of another one running at the same time
+OPENWEATHER_LOCK = threading.Lock()
+
+def run_xiaomi(config):
+    xiaomi = MODULES['read_Mi_Temp_Humid']
+    max_connections = config.get('max_connections', xiaomi.MAX_CONNECTIONS)
+    if config.get('adaptive'):
+        xiaomi.poll_adaptive(xiaomi.find_sensors(), max_connections)
+    else:
+        xiaomi.poll_sensors(xiaomi.find_sensors(), max_connections)
+    xiaomi.WRITER.flush_with_stats(xiaomi.STATS)
+
+def run_weather_current(config):
+    openweather = MODULES['openweather']
+    with OPENWEATHER_LOCK:
+        openweather.collect(current=True)
+        openweather.write_reports()
+
+def run_weather_daily(config):
+    openweather = MODULES['openweather']
+    with OPENWEATHER_LOCK:
+        openweather.collect(daily=True)
+        openweather.write_reports()
+
+def run_weather_forecast(config):
+    openweather = MODULES['openweather']
+    with OPENWEATHER_LOCK:
+        openweather.collect(forecast=True, numdays=config.get('numdays', 7))
+        openweather.write_reports()
+
+def run_breitbandmessung(config):
+    global BROWSER
+    breitbandmessung = MODULES['breitbandmessung']
+    if config.get('reuse_browser'):
+        if BROWSER is None:
+            BROWSER = breitbandmessung.BrowserSession(config.get('headless', True))
+        record = BROWSER.measure()
+    else:
+        record = breitbandmessung.get_data(headless=config.get('headless', True))
+    breitbandmessung.handle_data(storage=config.get('storage', 'csv'), records=[record] if record else None)
+    breitbandmessung.STATS.emit()
+
+def run_rollup(config):
+    global ROLLUP_CLIENT
+    rollup = MODULES['common.rollup']
+    if ROLLUP_CLIENT is None:
+        ROLLUP_CLIENT = rollup.client_from_env()
+    rollup.run(ROLLUP_CLIENT, os.getenv('INFLUXDB_DATABASE'))
+
+# job name: (module to import, function to run)
+JOBS = {
+    'xiaomi': ('read_Mi_Temp_Humid', run_xiaomi),
+    'weather_current': ('openweather', run_weather_current),
+    'weather_daily': ('openweather', run_weather_daily),
+    'weather_forecast': ('openweather', run_weather_forecast),
+    'breitbandmessung': ('breitbandmessung', run_breitbandmessung),
+    'rollup': ('common.rollup', run_rollup),
+}
+
+def load_config(path):
+    if not os.path.exists(path):
+        print('No {} found, using the default schedule'.format(path))
+        return DEFAULT_CONFIG
+    with open(path) as f:
+        config = json.load(f)
+    for name in config:
+        if name not in JOBS:
+            raise ValueError('unknown job {}, choose from {}'.format(name, ', '.join(JOBS)))
+        if 'schedule' not in config[name]:
+            raise ValueError('job {} has no schedule'.format(name))
+        # a bad schedule has to fail here, in the job's thread it would only stop that job
+        try:
+            parse_schedule(config[name]['schedule'])
+        except ValueError as e:
+            raise ValueError('job {}: {}'.format(name, e))
+    return config
+
+def parse_schedule(schedule):
+    # {"6-23": 10, "0-5": 30} -> minutes between runs for every hour of the day, None = don't run.
+    # a range like "22-5" wraps past midnight
+    if isinstance(schedule, int):
+        schedule = {'0-23': schedule}
+    if not isinstance(schedule, dict):
+        raise ValueError('schedule must be minutes or {{"hours": minutes}}, got {}'.format(schedule))
+    intervals = [None] * 24
+    for hours, every in schedule.items():
+        first, _, last = str(hours).partition('-')
+        try:
+            first, last, every = int(first), int(last or first), int(every)
+        except (TypeError, ValueError):
+            raise ValueError('invalid schedule entry "{}": {}'.format(hours, every))
+        if not (0 <= first <= 23 and 0 <= last <= 23):
+            raise ValueError('hours "{}" must be between 0 and 23'.format(hours))
+        if every <= 0:
+            raise ValueError('minutes between runs for "{}" must be positive, got {}'.format(hours, every))
+        for hour in range(first, last + 1 if first <= last else last + 25):
+            intervals[hour % 24] = every
+    return intervals
+
+def next_run(after, intervals):
+    # like cron */N: the next full minute within an active hour that is a multiple of the interval
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    for _ in range(2 * 24 * 60):
+        every = intervals[t.hour]
+        if every and (t.hour * 60 + t.minute) % every == 0:
+            return t
+        t += timedelta(minutes=1)
+    return None
+
+def run_job(name, config):
+    start = time.monotonic()
+    try:
+        JOBS[name][1](config)
+    except Exception as e:
+        print('[{}] Error: {}'.format(name, e))
+    print('[{}] finished in {:.1f}s'.format(name, time.monotonic() - start))
+
+def job_loop(name, config, stop):
+    # every job runs in its own thread so a long speedtest doesn't delay the sensors
+    intervals = parse_schedule(config['schedule'])
+    while not stop.is_set():
+        next_time = next_run(datetime.now(), intervals)
+        if next_time is None:
+            print('[{}] has no active hours, stopping'.format(name))
+            return
+        print('[{}] next run at {}'.format(name, next_time.strftime('%Y-%m-%d %H:%M')))
+        if stop.wait(max(0, (next_time - datetime.now()).total_seconds())):
+            return
+        run_job(name, config)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run all collectors from one long-running process')
+    parser.add_argument('--config', default=CONFIG, help='json file with the jobs and their schedules')
+    parser.add_argument('--once', choices=list(JOBS), help='run a single job once and exit')
+    parser.add_argument('--env', default=ENV_FILE, help='.env file shared by all collectors')
+    args = parser.parse_args()
+
+    # the collectors read their configuration when they are imported
+    if not dotenv.load_dotenv(args.env):
+        print('No {} found, the collectors use their own .env files'.format(args.env))
+
+    config = load_config(args.config)
+    if args.once:
+        config = {args.once: config.get(args.once, {})}
+
+    for name in config:
+        module = JOBS[name][0]
+        if module not in MODULES:
+            MODULES[module] = importlib.import_module(module)
+
+    if args.once:
+        run_job(args.once, config[args.once])
+        sys.exit(0)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    threads = [threading.Thread(target=job_loop, args=(name, job, stop), name=name) for name, job in config.items()]
+    for thread in threads:
+        thread.start()
+    stop.wait()
+    print('Stopping, waiting for running jobs to finish')
+    for thread in threads:
+        thread.join()
+    if BROWSER is not None:
+        BROWSER.close()
@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+import functools
+import contextlib
+
+from common.line_protocol import PointSchema
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+
+# where the stats of a run go: COLLECTOR_STATS=influxdb,textfile (none disables them).
+# the textfile is <collector>.prom in COLLECTOR_STATS_DIR, for node_exporter's textfile collector
+OUTPUTS = [o.strip() for o in os.getenv('COLLECTOR_STATS', 'influxdb').split(',') if o.strip() not in ('', 'none')]
+TEXTFILE_DIR = os.getenv('COLLECTOR_STATS_DIR', os.path.join(BASEPATH, '../data'))
+
+STAGE_SCHEMA = PointSchema('collector_stats', ('collector', 'stage'), ('calls', 'failures', 'duration', 'max_duration'))
+COUNTER_SCHEMA = PointSchema('collector_stats', ('collector',))
+
+class CollectorStats:
+    # durations of the stages and counters of one collector run, e.g.
+    #     with STATS.timer('read'): ...
+    #     STATS.count('retries')
+    # emit() writes them as collector_stats points or a prometheus textfile and starts over,
+    # so in the daemon every run reports its own numbers
+    def __init__(self, collector, outputs=None, textfile_dir=TEXTFILE_DIR):
+        self.collector = collector
+        self.outputs = OUTPUTS if outputs is None else outputs
+        self.textfile_dir = textfile_dir
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # stage: (calls, failures, total seconds, max seconds)
+            self.stages = {}
+            self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        # an exception counts as a failure of the stage and is passed on
+        start = time.monotonic()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.record(stage, time.monotonic() - start, failed)
+
+    def timed(self, stage):
+        # decorator version of timer() for functions with several returns
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, stage, duration, failed=False):
+        with self.lock:
+            calls, failures, total, longest = self.stages.get(stage, (0, 0, 0.0, 0.0))
+            self.stages[stage] = (calls + 1, failures + failed, total + duration, max(longest, duration))
+
+    def fail(self, stage):
+        # a stage that returned without raising but didn't deliver anything
+        with self.lock:
+            calls, failures, total, longest = self.stages.get(stage, (0, 0, 0.0, 0.0))
+            self.stages[stage] = (calls, failures + 1, total, longest)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_lines(self, now=None):
+        now = now or time.time_ns()
+        with self.lock:
+            lines = [STAGE_SCHEMA.encode((self.collector, stage), (calls, failures, total, longest), now)
+                     for stage, (calls, failures, total, longest) in sorted(self.stages.items())]
+            if self.counters:
+                lines.append(COUNTER_SCHEMA.encode_dict({'collector': self.collector}, self.counters, now))
+        return lines
+
+    def to_textfile(self, now=None):
+        now = now or time.time()
+        labels = 'collector="{}"'.format(self.collector)
+        out = []
+        with self.lock:
+            metrics = (('collector_stage_calls', 0, 'calls of the stage in the last run'),
+                       ('collector_stage_failures', 1, 'failed calls of the stage in the last run'),
+                       ('collector_stage_seconds', 2, 'time spent in the stage in the last run'),
+                       ('collector_stage_max_seconds', 3, 'longest call of the stage in the last run'))
+            for name, index, help_text in metrics:
+                out.append('# HELP {} {}\n# TYPE {} gauge'.format(name, help_text, name))
+                for stage, values in sorted(self.stages.items()):
+                    out.append('{}{{{},stage="{}"}} {}'.format(name, labels, stage, values[index]))
+            out.append('# HELP collector_events events counted in the last run\n# TYPE collector_events gauge')
+            for event, value in sorted(self.counters.items()):
+                out.append('collector_events{{{},event="{}"}} {}'.format(labels, event, value))
+        out.append('# TYPE collector_last_run_timestamp_seconds gauge\ncollector_last_run_timestamp_seconds{{{}}} {:.0f}'.format(labels, now))
+        return '\n'.join(out) + '\n'
+
+    def write_textfile(self):
+        os.makedirs(self.textfile_dir, exist_ok=True)
+        path = os.path.join(self.textfile_dir, '{}.prom'.format(self.collector))
+        # node_exporter must never see a half written file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_textfile())
+        os.replace(tmp_path, path)
+
+    def emit(self, writer=None):
+        # adds the points to the writer, the caller flushes it. without a writer
+        # (breitbandmessung has no influxdb) the stats go to the textfile instead
+        textfile = 'textfile' in self.outputs or ('influxdb' in self.outputs and writer is None)
+        try:
+            if 'influxdb' in self.outputs and writer is not None:
+                writer.add_lines(self.to_lines())
+            if textfile:
+                self.write_textfile()
+        except OSError as e:
+            print('Error writing collector stats: {}'.format(e))
+        self.reset()
@@ -0,0 +1,11 @@
+import os
+
+def client_from_env():
+    # influxdb-python pulls in requests, dateutil, pytz and (for its DataFrameClient) pandas when
+    # it is imported, so it is only imported when a client is actually needed
+    from influxdb import InfluxDBClient
+    return InfluxDBClient(host=os.getenv('INFLUXDB_HOST'),
+                          port=os.getenv('INFLUXDB_PORT'),
+                          username=os.getenv('INFLUXDB_USER'),
+                          password=os.getenv('INFLUXDB_PASSWORD'),
+                          database=os.getenv('INFLUXDB_DATABASE'))
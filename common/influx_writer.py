@@ -0,0 +1,158 @@
+import os
+import time
+import threading
+import contextlib
+from common.line_protocol import encode_point, encode_batch
+
+BATCH_SIZE = 5000
+RETRIES = 3
+
+class InfluxWriter:
+    # collects points for a whole run and writes them to influxdb in batches.
+    # points that can't be written are kept in a local spool file (line protocol)
+    # and are written first on the next run. with stats (a CollectorStats) the writes are timed.
+    # client can also be a function that creates it, it is only called when the client is first used.
+    # points influxdb refuses (4xx, e.g. a field type conflict) are moved to rejected_path instead,
+    # retrying them would fail forever and block everything spooled after them
+    def __init__(self, client, spool_path=None, batch_size=BATCH_SIZE, retries=RETRIES, database=None, stats=None,
+                 rejected_path=None):
+        self._client = client
+        self.stats = stats
+        self._database = database
+        self.spool_path = spool_path
+        self.rejected_path = rejected_path or (spool_path + '.rejected' if spool_path else None)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.pending = self._load_spool()
+        if self.pending:
+            print('Replaying {} spooled points from {}'.format(len(self.pending), self.spool_path))
+
+    @property
+    def client(self):
+        with self.lock:
+            if callable(self._client):
+                self._client = self._client()
+            return self._client
+
+    @property
+    def database(self):
+        return self._database or getattr(self.client, '_database', None)
+
+    def add(self, points):
+        # points in the dict format of write_points
+        self.add_lines([encode_point(point) for point in points])
+
+    def add_lines(self, lines):
+        # already encoded line protocol, see common.line_protocol
+        with self.lock:
+            self.pending.extend(lines)
+
+    def flush(self):
+        # returns the number of points written, rejected points are dropped,
+        # everything else stays pending and is spooled
+        with self.lock:
+            lines, self.pending = self.pending, []
+        written = 0
+        while lines:
+            batch = lines[:self.batch_size]
+            result = self._write(batch)
+            if result is None:
+                break
+            written += len(batch) if result else 0
+            lines = lines[self.batch_size:]
+        with self.lock:
+            self.pending = lines + self.pending
+            self._save_spool()
+        return written
+
+    def flush_with_stats(self, stats=None):
+        # writes the points, then the stats of the run (a CollectorStats) in a second small batch,
+        # they include the first write. if that failed influxdb is down, the stats are spooled
+        # instead of waiting through the retries a second time
+        stats = stats or self.stats
+        written = self.flush()
+        print('Wrote {} points to influxdb'.format(written))
+        if stats is not None:
+            stats.emit(self)
+        if self.pending:
+            self.spool()
+        else:
+            self.flush()
+        return written
+
+    def spool(self):
+        # influxdb is known to be unreachable, keep everything for the next run
+        with self.lock:
+            self._save_spool()
+
+    def write_batch(self, lines):
+        # write encoded lines right away, with retries but without spooling, for bulk imports.
+        # False if influxdb couldn't be reached, rejected lines count as done
+        return self._write(lines) is not None
+
+    def _write(self, batch):
+        # True if the batch was written, False if influxdb rejected it, None if it couldn't be reached
+        for attempt in range(self.retries + 1):
+            try:
+                # the batch is posted as one line protocol buffer, no json round trip
+                with self._timer('influxdb_write'):
+                    self.client.request('write', 'POST', params={'db': self.database, 'precision': 'n'},
+                                        data=encode_batch(batch), expected_response_code=204,
+                                        headers={'Content-Type': 'application/octet-stream'})
+                self._count('points_written', len(batch))
+                return True
+            except Exception as e:
+                print('Error writing {} points to influxdb: {}'.format(len(batch), e))
+                # InfluxDBClientError carries the status code, connection errors, timeouts and
+                # InfluxDBServerError (5xx) don't and are worth another try
+                code = getattr(e, 'code', None)
+                if isinstance(code, int) and 400 <= code < 500:
+                    self._reject(batch)
+                    return False
+                if attempt < self.retries:
+                    self._count('write_retries')
+                    print('Retrying, backing off for {} seconds'.format(2**attempt))
+                    time.sleep(2**attempt)
+        return None
+
+    def _reject(self, batch):
+        self._count('points_rejected', len(batch))
+        if self.rejected_path is None:
+            print('Dropped {} rejected points, the first one: {}'.format(len(batch), batch[0]))
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.rejected_path)), exist_ok=True)
+        with open(self.rejected_path, 'a') as f:
+            f.write('\n'.join(batch) + '\n')
+        print('Moved {} rejected points to {}'.format(len(batch), self.rejected_path))
+
+    def _timer(self, stage):
+        return self.stats.timer(stage) if self.stats is not None else contextlib.nullcontext()
+
+    def _count(self, name, n=1):
+        if self.stats is not None:
+            self.stats.count(name, n)
+
+    def _load_spool(self):
+        if self.spool_path is None or not os.path.exists(self.spool_path):
+            return []
+        with open(self.spool_path) as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+
+    def _save_spool(self):
+        # the spool always holds exactly the points that haven't been written yet
+        if self.spool_path is None:
+            if self.pending:
+                print('Error: {} points could not be written'.format(len(self.pending)))
+            return
+        if not self.pending:
+            if os.path.exists(self.spool_path):
+                os.remove(self.spool_path)
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.spool_path)), exist_ok=True)
+        tmp_path = self.spool_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(self.pending) + '\n')
+        os.replace(tmp_path, self.spool_path)
+        self._count('points_spooled', len(self.pending))
+        print('Spooled {} points to {}'.format(len(self.pending), self.spool_path))
@@ -0,0 +1,88 @@
+from datetime import datetime, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# escaping rules of the influxdb line protocol
+MEASUREMENT_ESCAPES = str.maketrans({',': '\\,', ' ': '\\ '})
+KEY_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ '})
+STRING_ESCAPES = str.maketrans({'"': '\\"', '\\': '\\\\'})
+
+def escape_measurement(value):
+    return str(value).translate(MEASUREMENT_ESCAPES)
+
+def escape_key(value):
+    return str(value).translate(KEY_ESCAPES)
+
+def encode_value(value):
+    # same types as influxdb-python's make_lines, so existing field types don't change
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(str(value).translate(STRING_ESCAPES))
+
+def to_ns(time):
+    # naive datetimes and date strings are UTC, like in make_lines
+    if time is None:
+        return None
+    if isinstance(time, int):
+        return time
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    delta = time - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10**9 + delta.microseconds * 1000
+
+class PointSchema:
+    # measurement, tag keys and field keys are escaped once, encoding a point only
+    # formats the values. unknown field keys are escaped on first use and cached
+    def __init__(self, measurement, tag_keys=(), field_keys=()):
+        self.prefix = escape_measurement(measurement)
+        self.tag_keys = tuple(tag_keys)
+        self.escaped_tags = tuple(escape_key(k) for k in self.tag_keys)
+        self.field_keys = tuple(field_keys)
+        self.escaped_fields = {k: escape_key(k) for k in self.field_keys}
+
+    def _field_key(self, key):
+        escaped = self.escaped_fields.get(key)
+        if escaped is None:
+            escaped = self.escaped_fields[key] = escape_key(key)
+        return escaped
+
+    def encode(self, tags, fields, time=None):
+        # tags: values in the order of tag_keys, fields: values in the order of field_keys
+        line = self.prefix
+        for key, value in zip(self.escaped_tags, tags):
+            if value is not None and value != '':
+                line += ',{}={}'.format(key, escape_key(value))
+        line += ' ' + ','.join('{}={}'.format(self.escaped_fields[key], encode_value(value))
+                               for key, value in zip(self.field_keys, fields) if value is not None)
+        ns = to_ns(time)
+        return line if ns is None else '{} {}'.format(line, ns)
+
+    def encode_dict(self, tags, fields, time=None):
+        # tags and fields as dicts, for readings without a fixed set of fields
+        line = self.prefix
+        for key, value in sorted(tags.items()):
+            if value is not None and value != '':
+                line += ',{}={}'.format(escape_key(key), escape_key(value))
+        line += ' ' + ','.join('{}={}'.format(self._field_key(key), encode_value(value))
+                               for key, value in fields.items() if value is not None)
+        ns = to_ns(time)
+        return line if ns is None else '{} {}'.format(line, ns)
+
+SCHEMAS = {}
+
+def encode_point(point):
+    # encode a point in the {'measurement', 'tags', 'time', 'fields'} format of write_points
+    schema = SCHEMAS.get(point['measurement'])
+    if schema is None:
+        schema = SCHEMAS[point['measurement']] = PointSchema(point['measurement'])
+    return schema.encode_dict(point.get('tags') or {}, point['fields'], point.get('time'))
+
+def encode_batch(lines):
+    # one buffer for a whole batch, ready to be posted to /write
+    return ('\n'.join(lines) + '\n').encode('utf-8')
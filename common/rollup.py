@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import dotenv
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASEPATH, '..'))
+from common.influx_client import client_from_env
+STATE_PATH = os.path.join(BASEPATH, '../data/rollup_state.json')
+
+env = dotenv.load_dotenv()
+
+# fields that are rolled up to min/mean/max per location
+ROLLUPS = {
+    'temp_sensor': ('temperature', 'humidity', 'battery'),
+    'current_weather': ('temperature', 'felt temp', 'humidity', 'pressure', 'wind speed', 'cloud coverage'),
+}
+INTERVALS = {
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+# one query never covers more than this, so the first run over years of data stays manageable.
+# a multiple of all intervals, so windows stay aligned to the buckets
+WINDOW = timedelta(days=30)
+
+ROLLUP_RP = os.getenv('ROLLUP_RETENTION_POLICY', 'rollup')
+# buckets before the watermark that are rolled up again on every run, for points that arrive
+# late from a spool. SELECT INTO overwrites the points of a bucket, so this is safe
+LOOKBACK = int(os.getenv('ROLLUP_LOOKBACK', 2))
+
+def quote(name):
+    return '"{}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+
+def timestamp(time):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def floor_time(time, interval):
+    # influxdb buckets start at the epoch, so do ours
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return epoch + (time - epoch) // interval * interval
+
+def rollup_measurement(measurement, name):
+    return '{}_{}'.format(measurement, name)
+
+def rollup_query(measurement, fields, name, start, end, database, rp=ROLLUP_RP):
+    aggregates = ', '.join('{}({}) AS {}'.format(func, quote(field), quote('{}_{}'.format(field, func)))
+                           for field in fields for func in ('min', 'mean', 'max'))
+    return 'SELECT {} INTO {}.{}.{} FROM {} WHERE time >= \'{}\' AND time < \'{}\' GROUP BY time({}), "location"'.format(
+        aggregates, quote(database), quote(rp), quote(rollup_measurement(measurement, name)),
+        quote(measurement), timestamp(start), timestamp(end), name)
+
+def first_time(client, measurement, field):
+    points = list(client.query('SELECT first({}) FROM {}'.format(quote(field), quote(measurement))).get_points())
+    if not points:
+        return None
+    return datetime.strptime(points[0]['time'][:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+
+def load_state(path=STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(state, path=STATE_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, path)
+
+def ensure_retention_policy(client, database, rp=ROLLUP_RP, duration='INF'):
+    if rp not in [policy['name'] for policy in client.get_list_retention_policies(database)]:
+        print('Creating retention policy {} ({}) for the rollups'.format(rp, duration))
+        client.create_retention_policy(rp, duration, 1, database=database)
+
+def setup_retention(client, database, raw_duration=None, rollup_duration='INF', rp=ROLLUP_RP):
+    # rollups go to their own retention policy, raw data can be limited with raw_duration (e.g. 365d)
+    ensure_retention_policy(client, database, rp, rollup_duration)
+    if raw_duration:
+        default = [policy['name'] for policy in client.get_list_retention_policies(database) if policy['default']][0]
+        print('Keeping raw data in {} for {}'.format(default, raw_duration))
+        client.alter_retention_policy(default, database=database, duration=raw_duration)
+
+def parse_time(text):
+    return datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
+def run(client, database, state_path=STATE_PATH, now=None, since=None, reset=False, lookback=LOOKBACK):
+    # rolls up everything between the last watermark (minus lookback buckets) and the last complete bucket.
+    # since rebuilds everything after that time, reset everything from the first point on, e.g. after a backfill
+    now = now or datetime.now(timezone.utc)
+    state = {} if reset else load_state(state_path)
+    ensure_retention_policy(client, database)
+    written = 0
+    for measurement, fields in ROLLUPS.items():
+        for name, interval in INTERVALS.items():
+            key = rollup_measurement(measurement, name)
+            if since is not None:
+                start = floor_time(since, interval)
+            elif key in state:
+                start = parse_time(state[key]) - lookback * interval
+            else:
+                start = first_time(client, measurement, fields[0])
+                if start is None:
+                    continue
+                start = floor_time(start, interval)
+            end = floor_time(now, interval)
+            while start < end:
+                window_end = min(end, start + WINDOW)
+                result = client.query(rollup_query(measurement, fields, name, start, window_end, database))
+                points = list(result.get_points())
+                written += points[0]['written'] if points else 0
+                start = window_end
+                state[key] = timestamp(start)
+                save_state(state, state_path)
+            print('{} up to {}'.format(key, state.get(key)))
+    print('Wrote {} rollup points'.format(written))
+    return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Roll up temp_sensor and current_weather to hourly and daily min/mean/max')
+    parser.add_argument('--setup-retention', action='store_true', help='create the rollup retention policy and exit')
+    parser.add_argument('--raw-duration', help='with --setup-retention: how long to keep raw data, e.g. 365d')
+    parser.add_argument('--since', type=lambda text: parse_time(text if 'T' in text else text + 'T00:00:00Z'),
+                        help='roll up everything again from this UTC time on, e.g. 2023-01-01 after a backfill')
+    parser.add_argument('--reset', action='store_true', help='roll up everything again from the first point on')
+    args = parser.parse_args()
+
+    database = os.getenv('INFLUXDB_DATABASE')
+    client = client_from_env()
+    if args.setup_retention:
+        setup_retention(client, database, args.raw_duration)
+        sys.exit(0)
+    run(client, database, since=args.since, reset=args.reset)
@@ -0,0 +1,59 @@
+import os
+import sys
+import subprocess
+import importlib.util
+
+BASEPATH = os.path.dirname(os.path.abspath(__file__))
+
+# packages that are slow to import on a raspberry pi, none of them should be loaded
+# before a script knows it needs them
+HEAVY = ('influxdb', 'requests', 'urllib3', 'pandas', 'numpy', 'pyarrow', 'selenium', 'bluepy')
+
+def import_times(modules, path):
+    # imports the modules in a fresh interpreter with -X importtime, returns
+    # [(depth, cumulative microseconds, module)] in the order python printed them
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [path, os.path.join(BASEPATH, '..'), os.getenv('PYTHONPATH')])))
+    code = 'import ' + ', '.join(modules)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=path, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times = []
+    for line in proc.stderr.decode('utf-8', errors='replace').splitlines():
+        if 'imported package' in line:
+            continue
+        if not line.startswith('import time:'):
+            # a traceback, e.g. a dependency that isn't installed
+            if line.strip():
+                print(line)
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((depth, int(cumulative), name.strip()))
+    return times
+
+def report(module, path, extra=(), top=8):
+    # what a run pays before it does anything: the import of the script itself and of the
+    # dependencies in extra, which are only imported by the commands that need them
+    missing = [name for name in extra if importlib.util.find_spec(name.split('.')[0]) is None]
+    times = import_times([module] + [name for name in extra if name not in missing], path)
+    if not times:
+        return
+    print('{:<40} {:>10}'.format('import', 'ms'))
+    for name in (module, *extra):
+        # the last line of a top level import is the import itself with the cumulative time
+        total = next((us for depth, us, n in reversed(times) if depth == 0 and n == name), None)
+        if name in missing:
+            print('{:<40} {:>10}'.format(name, 'not installed'))
+        elif total is not None:
+            print('{:<40} {:>10.1f}'.format(name, total / 1000))
+    # the imports of the script are printed right before the line of the script itself
+    end = next((i for i, (depth, _, n) in enumerate(times) if depth == 0 and n == module), len(times) - 1)
+    start = max((i + 1 for i, (depth, _, _) in enumerate(times[:end]) if depth == 0), default=0)
+    children = sorted((t for t in times[start:end] if t[0] == 1), key=lambda t: -t[1])[:top]
+    if children:
+        print('slowest imports of {}:'.format(module))
+        for _, us, name in children:
+            print('  {:<38} {:>10.1f}'.format(name, us / 1000))
+    # failed optional imports show up too, only count what is installed
+    loaded = sorted(n for n in {n.split('.')[0] for _, _, n in times[start:end]} & set(HEAVY)
+                    if importlib.util.find_spec(n) is not None)
+    print('heavy packages imported by {}: {}'.format(module, ', '.join(loaded) or 'none'))
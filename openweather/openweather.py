@@ -1,11 +1,12 @@
 import os
+import sys
+import threading
 from datetime import datetime
-import requests
+from concurrent.futures import ThreadPoolExecutor
 import dotenv
 import json
 import argparse
 import time
-from influxdb import InfluxDBClient
 from enum import Enum
 
 class ReportType(Enum):
@@ -33,6 +34,12 @@ class Direction(Enum):
     NNW = 16
 
 BASEPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASEPATH, '..'))
+from common.influx_writer import InfluxWriter
+from common.influx_client import client_from_env
+from common.line_protocol import PointSchema
+from common.collector_stats import CollectorStats
+from response_cache import ResponseCache
 
 url="http://localhost:8086"
 
@@ -43,14 +50,63 @@ API_KEY = os.getenv('API_KEY')
 UNITS = 'metric'
 LANG = 'de'
 API_BASE_URL = 'http://api.openweathermap.org/data/2.5/'
+def parse_locations(value):
+    # LOCATIONS=Home:52.52,13.40;Office:48.13,11.57 (the name is optional, default is the city name from the api)
+    locations = []
+    for entry in filter(None, (e.strip() for e in value.split(';'))):
+        name, _, coords = entry.rpartition(':')
+        lat, lon = (c.strip() for c in coords.split(','))
+        locations.append({'name': name.strip() or None, 'lat': lat, 'lon': lon})
+    return locations
 
-CLIENT = InfluxDBClient(host=os.getenv('INFLUXDB_HOST'),
-                                port=os.getenv('INFLUXDB_PORT'),
-                                username=os.getenv('INFLUXDB_USER'),
-                                password=os.getenv('INFLUXDB_PASSWORD'),
-                                database=os.getenv('INFLUXDB_DATABASE'))
+LOCATIONS = parse_locations(os.getenv('LOCATIONS', '')) or [{'name': None, 'lat': LAT, 'lon': LON}]
+# (connect, read) timeout in seconds, a hung request must not stall the cron job
+TIMEOUT = (5, 15)
+# concurrent requests, stays below the connection pool size of the session
+MAX_WORKERS = 8
+
+# one session for all requests so connections are kept alive and reused, see get_session
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+# responses are cached on disk, forecasts only change a few times a day
+CACHE = ResponseCache(os.getenv('CACHE_DIR', os.path.join(BASEPATH, '../data/openweather_cache')))
+CACHE_TTL = {
+    ReportType.CURRENT: 5 * 60,
+    ReportType.DAILY: 3 * 60 * 60,
+    ReportType.FORECAST: 3 * 60 * 60,
+    ReportType.WEEKLY: 3 * 60 * 60,
+}
+
+# request durations, cache hits and failures of a run, written as collector_stats with the reports
+STATS = CollectorStats('openweather')
+
+# all reports of a run are written in one batch, or spooled if influxdb is down.
+# the influxdb client is only created for that write, not with --ignore_db
+WRITER = InfluxWriter(client_from_env, spool_path=os.path.join(BASEPATH, '../data/openweather_spool.lp'), stats=STATS)
+
+MEASUREMENTS = {
+    ReportType.CURRENT: 'current_weather',
+    ReportType.FORECAST: 'forecast_weather',
+    ReportType.DAILY: 'today_weather',
+    ReportType.WEEKLY: 'weekly_weather',
+}
+
+# every field a report can have, their escaped keys are precompiled once
+CURRENT_FIELDS = ('weather', 'weather description', 'weather icon', 'temperature', 'felt temp', 'humidity',
+                  'pressure', 'visibility', 'cloud coverage', 'wind speed', 'wind deg', 'rain next hour',
+                  'rain next 3 hours', 'snow next hour', 'snow next 3 hours')
+FORECAST_FIELDS = ('date', 'sunrise', 'sunset', 'weather', 'weather description', 'weather icon',
+                   'temp morning', 'felt temp morning', 'temp day', 'felt temp day', 'temp evening',
+                   'felt temp evening', 'temp night', 'felt temp night', 'temp min', 'temp max', 'pressure',
+                   'humidity', 'cloud coverage', 'wind speed', 'wind deg', 'wind gust', 'pop', 'rain volume',
+                   'snow volume')
 
 class WeatherReport:
+    __slots__ = ('timestamp', 'location', 'coords', 'type', 'data')
+    SCHEMAS = {type: PointSchema(measurement, ('location',), CURRENT_FIELDS if type == ReportType.CURRENT else FORECAST_FIELDS)
+               for type, measurement in MEASUREMENTS.items()}
+
     def __init__(self, type: ReportType):
         self.timestamp = datetime.now()
         self.location = None
@@ -61,7 +117,7 @@ class WeatherReport:
     def __str__(self):
         return json.dumps(self.data, indent=4, sort_keys=True, ensure_ascii=False)
     
-    def write_to_influxdb(self, client):
+    def to_point(self):
         if self.type == ReportType.CURRENT:
             measurement = 'current_weather'
             time = self.timestamp
@@ -74,15 +130,29 @@ class WeatherReport:
             elif self.type == ReportType.WEEKLY:
                 measurement = 'weekly_weather'
         
-        report_data = [
-            {'measurement': measurement,
+        return {'measurement': measurement,
                 'tags': {'location': self.location},
                 'time': time,
                 'fields': self.data
             }
-        ]
-        client.write_points(report_data)
-        
+
+    def as_type(self, type: ReportType):
+        report = WeatherReport(type)
+        report.timestamp = self.timestamp
+        report.location = self.location
+        report.coords = dict(self.coords)
+        report.data = dict(self.data)
+        return report
+
+    def to_line(self):
+        time = self.timestamp if self.type == ReportType.CURRENT else self.data['date']
+        return self.SCHEMAS[self.type].encode_dict({'location': self.location}, self.data, time)
+
+    def write_to_influxdb(self, writer):
+        with STATS.timer('encode'):
+            line = self.to_line()
+        writer.add_lines([line])
+        STATS.count('reports')
 
     # TODO improve validity check
     def is_valid(self):
@@ -91,127 +161,259 @@ class WeatherReport:
         else:
             return True
 
-def getCurrentData() -> WeatherReport:
-    print('Getting data from openweathermap')
-    API_CURRENT_URL='{}weather?lat={}&lon={}&appid={}&units={}&lang={}'.format(API_BASE_URL, LAT, LON, API_KEY, UNITS, LANG)
+def get_session():
+    # created on the first request, a run that is answered from the cache doesn't import requests.
+    # rate limited (429) and server errors are retried with exponential backoff
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=['GET'], respect_retry_after_header=True, raise_on_status=False)
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(max_retries=retry))
+            session.mount('https://', HTTPAdapter(max_retries=retry))
+            SESSION = session
+        return SESSION
+
+def fetch_json(url, ttl):
+    # returns the decoded response, from the cache if it is younger than ttl seconds
+    key = CACHE.key(url) if CACHE is not None else None
+    entry = CACHE.get(key) if key is not None else None
+    # a response from before midnight starts its forecast with yesterday
+    if entry is not None and time.time() - entry['fetched_at'] < ttl and \
+            datetime.fromtimestamp(entry['fetched_at']).date() == datetime.now().date():
+        print('Using cached response from {}'.format(datetime.fromtimestamp(entry['fetched_at']).strftime('%H:%M:%S')))
+        STATS.count('cache_hits')
+        return entry['body']
+    with STATS.timer('http_request'):
+        response = get_session().get(url, timeout=TIMEOUT, headers=ResponseCache.conditional_headers(entry))
+    if response.status_code == 304 and entry is not None:
+        # not modified, keep the cached body for another ttl
+        STATS.count('not_modified')
+        return CACHE.put(key, entry['body'], response.headers)['body']
+    if response.status_code != 200:
+        print('Error: {}, response: {}'.format(response.status_code, response.content))
+        STATS.count('http_errors')
+        return None
+    res = response.json()
+    if key is not None:
+        CACHE.put(key, res, response.headers)
+    return res
+
+def parse_current(res, location) -> WeatherReport:
+    # build the report from a /weather response
+    weather = WeatherReport(ReportType.CURRENT)
+
+    # set location and coords
+    weather.location = location['name'] or res['name']
+    weather.coords['lat'] = res['coord']['lat']
+    weather.coords['lon'] = res['coord']['lon']
+
+    # weather description (first in list)
+    weather_desc = res['weather'][0]
+    weather.data['weather'] = weather_desc['main']
+    weather.data['weather description'] = weather_desc['description']
+    weather.data['weather icon'] = weather_desc['icon']
+
+    # main data
+    main = res['main']
+    weather.data['temperature'] = main['temp']
+    weather.data['felt temp'] = main['feels_like']
+    weather.data['humidity'] = main['humidity']
+    weather.data['pressure'] = main['pressure']
+    weather.data['visibility'] = res['visibility']
+    weather.data['cloud coverage'] = res['clouds']['all']
+    
+    # wind speed and direction
+    wind = res['wind']
+    weather.data['wind speed'] = wind['speed']
+    weather.data['wind deg'] = wind['deg']
+
+    if 'rain' in res:
+        weather.data['rain next hour'] = res['rain']['1h']
+        if '3h' in res['rain']:
+            weather.data['rain next 3 hours'] = res['rain']['3h']
+    if 'snow' in res:
+        weather.data['snow next hour'] = res['snow']['1h']
+        if '3h' in res['snow']:    
+            weather.data['snow next 3 hours'] = res['snow']['3h']
+    return weather
+
+def current_url(location):
+    return '{}weather?lat={}&lon={}&appid={}&units={}&lang={}'.format(API_BASE_URL, location['lat'], location['lon'], API_KEY, UNITS, LANG)
+
+def getCurrentData(location=None) -> WeatherReport:
+    location = location or LOCATIONS[0]
+    print('Getting data from openweathermap for {}'.format(location['name'] or '{}, {}'.format(location['lat'], location['lon'])))
     try:
-        response = requests.get(API_CURRENT_URL)
-        # create the report
-        weather = WeatherReport(ReportType.CURRENT)
-        if response.status_code == 200:
-            res = response.json()
-            
-            # set location and coords
-            weather.location = res['name']
-            weather.coords['lat'] = res['coord']['lat']
-            weather.coords['lon'] = res['coord']['lon']
-
-            # weather description (first in list)
-            weather_desc = res['weather'][0]
-            weather.data['weather'] = weather_desc['main']
-            weather.data['weather description'] = weather_desc['description']
-            weather.data['weather icon'] = weather_desc['icon']
-
-            # main data
-            main = res['main']
-            weather.data['temperature'] = main['temp']
-            weather.data['felt temp'] = main['feels_like']
-            weather.data['humidity'] = main['humidity']
-            weather.data['pressure'] = main['pressure']
-            weather.data['visibility'] = res['visibility']
-            weather.data['cloud coverage'] = res['clouds']['all']
-            
-            # wind speed and direction
-            wind = res['wind']
-            weather.data['wind speed'] = wind['speed']
-            weather.data['wind deg'] = wind['deg']
-
-            if 'rain' in res:
-                weather.data['rain next hour'] = res['rain']['1h']
-                if '3h' in res['rain']:
-                    weather.data['rain next 3 hours'] = res['rain']['3h']
-            if 'snow' in res:
-                weather.data['snow next hour'] = res['snow']['1h']
-                if '3h' in res['snow']:    
-                    weather.data['snow next 3 hours'] = res['snow']['3h']
-        else:
-            print('Error: {}, response: {}'.format(response.status_code, response.content))
-        return weather
+        with STATS.timer('current'):
+            res = fetch_json(current_url(location), CACHE_TTL[ReportType.CURRENT])
+            if res is None:
+                STATS.fail('current')
+                return WeatherReport(ReportType.CURRENT)
+            return parse_current(res, location)
     except Exception as e:
         print('Error: {}'.format(e))
         return None
 
-def getDailyForecastData(cnt = 7) -> list:
-    print('Getting forecast data from openweathermap for {} days'.format(cnt))
-    API_FORECAST_URL='{}forecast/daily?lat={}&lon={}&appid={}&cnt={}&units={}&lang={}'.format(API_BASE_URL, LAT, LON, API_KEY, cnt, UNITS, LANG)    
+def forecast_report_type(cnt):
+    if (cnt == 1):
+        return ReportType.DAILY
+    elif ((cnt > 1) and (cnt < 7)):
+        return ReportType.FORECAST
+    elif (cnt == 7):
+        return ReportType.WEEKLY
+    elif ((cnt > 7) and (cnt <= 16)):
+        return ReportType.FORECAST
+    return None
+
+def parse_forecast(res, location, report_type) -> list:
+    # build one report per day from a /forecast/daily response
     results = []
+    city = res['city']
+    # retrieve list of forecast data
+    forecasts = res['list']
+    for forecast in forecasts:
+        weather = WeatherReport(report_type)
+
+        # set location and coords
+        weather.location = location['name'] or city['name']
+        weather.coords = city['coord']
+        weather.data['date'] = datetime.fromtimestamp(int(forecast['dt'])).strftime("%Y-%m-%d") # convert unix timestamp to date as string
+        weather.data['sunrise'] = datetime.fromtimestamp(int(forecast['sunrise'])).strftime("%H:%M:%S")
+        weather.data['sunset'] = datetime.fromtimestamp(int(forecast['sunset'])).strftime("%H:%M:%S")
+
+        # collect general weather data
+        weather_desc = forecast['weather'][0]
+        weather.data['weather'] = weather_desc['main']
+        weather.data['weather description'] = weather_desc['description']
+        weather.data['weather icon'] = weather_desc['icon']
+        
+        # collect temp data
+        weather.data['temp morning'] = forecast['temp']['morn']
+        weather.data['felt temp morning'] = forecast['feels_like']['morn']
+        weather.data['temp day'] = forecast['temp']['day']
+        weather.data['felt temp day'] = forecast['feels_like']['day']
+        weather.data['temp evening'] = forecast['temp']['eve']
+        weather.data['felt temp evening'] = forecast['feels_like']['eve']
+        weather.data['temp night'] = forecast['temp']['night']
+        weather.data['felt temp night'] = forecast['feels_like']['night']
+        weather.data['temp min'] = forecast['temp']['min']
+        weather.data['temp max'] = forecast['temp']['max']
+        
+        # collect other data
+        weather.data['pressure'] = forecast['pressure']
+        weather.data['humidity'] = forecast['humidity']
+        weather.data['cloud coverage'] = forecast['clouds']
+        weather.data['wind speed'] = forecast['speed']
+        weather.data['wind deg'] = forecast['deg']
+        weather.data['wind gust'] = forecast['gust']
+        weather.data['pop'] = int(forecast['pop']*100) # convert to percent
+
+        # collect rain data
+        if 'rain' in forecast:
+            weather.data['rain volume'] = forecast['rain']
+        if 'snow' in forecast:
+            weather.data['snow volume'] = forecast['snow']
+
+        results.append(weather)
+    return results
+
+def forecast_url(location, cnt):
+    return '{}forecast/daily?lat={}&lon={}&appid={}&cnt={}&units={}&lang={}'.format(API_BASE_URL, location['lat'], location['lon'], API_KEY, cnt, UNITS, LANG)
+
+def getDailyForecastData(cnt = 7, location=None, report_type=None) -> list:
+    location = location or LOCATIONS[0]
+    print('Getting forecast data from openweathermap for {} days for {}'.format(cnt, location['name'] or '{}, {}'.format(location['lat'], location['lon'])))
+    if report_type is None:
+        report_type = forecast_report_type(cnt)
+        if report_type is None:
+            print('Error: invalid cnt value')
+            return None
     try:
-        response = requests.get(API_FORECAST_URL)
-        # create the report        
-        if response.status_code == 200:
-            res = response.json()
-            city = res['city']
-            # retrieve list of forecast data
-            forecasts = res['list']
-            for forecast in forecasts:
-                if (cnt == 1):
-                    weather = WeatherReport(ReportType.DAILY)
-                elif ((cnt > 1) and (cnt < 7)):
-                    weather = WeatherReport(ReportType.FORECAST)
-                elif (cnt == 7):
-                    weather = WeatherReport(ReportType.WEEKLY)
-                else:
-                    print('Error: invalid cnt value')
-                    return None
-
-                # set location and coords
-                weather.location = city['name']
-                weather.coords = city['coord']
-                weather.data['date'] = datetime.fromtimestamp(int(forecast['dt'])).strftime("%Y-%m-%d") # convert unix timestamp to date as string
-                weather.data['sunrise'] = datetime.fromtimestamp(int(forecast['sunrise'])).strftime("%H:%M:%S")
-                weather.data['sunset'] = datetime.fromtimestamp(int(forecast['sunset'])).strftime("%H:%M:%S")
-
-                # collect general weather data
-                weather_desc = forecast['weather'][0]
-                weather.data['weather'] = weather_desc['main']
-                weather.data['weather description'] = weather_desc['description']
-                weather.data['weather icon'] = weather_desc['icon']
-                
-                # collect temp data
-                weather.data['temp morning'] = forecast['temp']['morn']
-                weather.data['felt temp morning'] = forecast['feels_like']['morn']
-                weather.data['temp day'] = forecast['temp']['day']
-                weather.data['felt temp day'] = forecast['feels_like']['day']
-                weather.data['temp evening'] = forecast['temp']['eve']
-                weather.data['felt temp evening'] = forecast['feels_like']['eve']
-                weather.data['temp night'] = forecast['temp']['night']
-                weather.data['felt temp night'] = forecast['feels_like']['night']
-                weather.data['temp min'] = forecast['temp']['min']
-                weather.data['temp max'] = forecast['temp']['max']
-                
-                # collect other data
-                weather.data['pressure'] = forecast['pressure']
-                weather.data['humidity'] = forecast['humidity']
-                weather.data['cloud coverage'] = forecast['clouds']
-                weather.data['wind speed'] = forecast['speed']
-                weather.data['wind deg'] = forecast['deg']
-                weather.data['wind gust'] = forecast['gust']
-                weather.data['pop'] = int(forecast['pop']*100) # convert to percent
-
-                # collect rain data
-                if 'rain' in forecast:
-                    weather.data['rain volume'] = forecast['rain']
-                if 'snow' in forecast:
-                    weather.data['snow volume'] = forecast['snow']
-
-                results.append(weather)
-        else:
-            print('Error: {}, response: {}'.format(response.status_code, response.content))
-        return results            
+        with STATS.timer('forecast'):
+            res = fetch_json(forecast_url(location, cnt), CACHE_TTL[report_type])
+            if res is None:
+                STATS.fail('forecast')
+                return []
+            return parse_forecast(res, location, report_type)
     except Exception as e:
         print('Error: {}'.format(e))
         return None
 
+# forecast length requested for --daily alone, so the response is shared with the default --forecast
+DAILY_FROM_DAYS = 7
+
+def fetch_all(calls, parallel=False):
+    # calls: {name: (function, *args)}, with parallel all requests are sent at the same time
+    if not parallel or len(calls) < 2:
+        return {name: func(*args) for name, (func, *args) in calls.items()}
+    with ThreadPoolExecutor(max_workers=min(len(calls), MAX_WORKERS)) as executor:
+        futures = {name: executor.submit(func, *args) for name, (func, *args) in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+@STATS.timed('collect')
+def collect(current=False, daily=False, forecast=False, numdays=7, writer=WRITER, parallel=False, locations=None):
+    # fetch the requested reports for all locations and add the valid ones to the writer,
+    # everything ends up in a single batched write
+    locations = locations or LOCATIONS
+    if forecast and not (numdays > 1 and numdays <= 16):
+        print('Error: invalid number of days, choose between 1 and 16')
+        forecast = False
+    # todays report is the first day of the n-day forecast, both share one (cached) request
+    forecast_days = numdays if forecast else DAILY_FROM_DAYS
+    calls = {}
+    for i, location in enumerate(locations):
+        if current:
+            calls[('current', i)] = (getCurrentData, location)
+        if daily or forecast:
+            calls[('forecast', i)] = (getDailyForecastData, forecast_days, location)
+    # several locations are always fetched concurrently
+    results = fetch_all(calls, parallel or len(locations) > 1)
+
+    for i in range(len(locations)):
+        # get current weather data
+        if current:
+            current_weather = results[('current', i)]
+            if current_weather is not None and current_weather.is_valid():
+                current_weather.write_to_influxdb(writer)
+            else:
+                print('Invalid current weather report!')
+        
+        # todays forecast data
+        
+        if daily:
+            today = datetime.now().strftime("%Y-%m-%d")
+            todays_forecast = next((report for report in results[('forecast', i)] or [] if report.data.get('date') == today), None)
+            if todays_forecast is not None and todays_forecast.is_valid():
+                todays_forecast.as_type(ReportType.DAILY).write_to_influxdb(writer)
+            else:
+                print('Invalid daily weather report!')
+        
+        if forecast:
+            # get daily forecast data
+            forecast_list = results[('forecast', i)] or []
+            for report in forecast_list:
+                if report.is_valid():
+                    report.write_to_influxdb(writer)
+                else:
+                    print('Invalid forecast weather report!')
+
+def write_reports(writer=WRITER):
+    # write everything in one batch, keep it in the spool if influxdb is not available
+    try:
+        writer.client.ping()
+    except Exception as e:
+        print('Error: influxdb is not available: {}'.format(e))
+        STATS.count('influxdb_unavailable')
+        STATS.emit(writer)
+        writer.spool()
+        return 0
+    return writer.flush_with_stats(STATS)
+
 if __name__ == "__main__":
 
     # read args
@@ -220,51 +422,20 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--forecast', action='store_true', help='get forecast weather data')
     parser.add_argument('-d', '--daily', action='store_true', help='get daily weather data')
     parser.add_argument('-n', '--numdays', type=int, default=7, help='number of days to get forecast data for')
+    parser.add_argument('-p', '--parallel', action='store_true', help='send all requests at the same time')
+    parser.add_argument('--no-cache', action='store_true', help='always request fresh data from openweathermap')
     parser.add_argument('--ignore_db', action='store_true', default=False, help="don't write to influxdb, good for testing")
+    parser.add_argument('--profile-startup', action='store_true', help='show what the imports of this script cost and exit')
     
     args = parser.parse_args()
-    # init db connection
-    db_available = False
 
+    if args.profile_startup:
+        from common import startup_profile
+        startup_profile.report('openweather', BASEPATH, ['requests'] + ([] if args.ignore_db else ['influxdb']))
+        sys.exit(0)
+
+    if args.no_cache:
+        CACHE = None
+    collect(args.current, args.daily, args.forecast, args.numdays, parallel=args.parallel)
     if not args.ignore_db:
-        try:
-            CLIENT.ping()
-            db_available = True
-        except Exception as e:
-            print('Error: {}'.format(e))
-
-    # get current weather data
-    if args.current:
-        current_weather = getCurrentData()
-        if current_weather.is_valid() and db_available:
-            current_weather.write_to_influxdb(CLIENT)
-        elif db_available == False:
-            print('Error: influxdb is not available')
-        else:
-            print('Invalid current weather report!')
-    
-    # todays forecast data
-    
-    if args.daily:
-        todays_forecast = getDailyForecastData(cnt=1)[0] # get only the first day
-        if todays_forecast.is_valid() and db_available:
-            todays_forecast.write_to_influxdb(CLIENT)
-        elif db_available == False:
-            print('Error: influxdb is not available')
-        else:
-            print('Invalid daily weather report!')
-    
-    if args.forecast:
-        if args.numdays > 1 and args.numdays <= 16:
-            # get daily forecast data
-            forecast_list = getDailyForecastData(args.numdays)
-            for forecast in forecast_list:
-                if forecast.is_valid() and db_available:
-                    forecast.write_to_influxdb(CLIENT)
-                    time.sleep(0.1) # wait 0.1 ms between writes to influxdb to avoid duplicate entries
-                elif db_available == False:
-                    print('Error: influxdb is not available')
-                else:
-                    print('Invalid forecast weather report!')
-        else:
-            print('Error: invalid number of days, choose between 1 and 16')
\ No newline at end of file
+        write_reports()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import contextlib
+
+MAX_ENTRIES = 64
+
+class ResponseCache:
+    # on-disk cache for api responses, one json file per request url.
+    # entries are evicted least recently used first once there are more than max_entries.
+    # the cache is only an optimization, a full disk or an unwritable path must never cost a response
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+    def key(self, url):
+        # the url contains the api key, only its hash ends up on disk
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._file(key)) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print('Error reading cached response {}: {}'.format(key, e))
+            return None
+        try:
+            # mtime is the last access time for the lru eviction
+            os.utime(self._file(key))
+        except OSError:
+            # evicted by another fetch in the meantime, the entry is still good
+            pass
+        return entry
+
+    def put(self, key, body, headers=None):
+        headers = headers or {}
+        entry = {
+            'fetched_at': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'body': body
+        }
+        # one tmp file per thread, parallel fetches of the same url must not share it
+        tmp_path = '{}.{}.tmp'.format(self._file(key), threading.get_ident())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._file(key))
+        except OSError as e:
+            print('Error caching response {}: {}'.format(key, e))
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            return entry
+        self.evict()
+        return entry
+
+    def evict(self):
+        try:
+            files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith('.json')]
+        except OSError as e:
+            print('Error listing the response cache: {}'.format(e))
+            return
+        if len(files) <= self.max_entries:
+            return
+        mtimes = {}
+        for f in files:
+            # another fetch thread may have evicted it already
+            with contextlib.suppress(OSError):
+                mtimes[f] = os.path.getmtime(f)
+        files = sorted(mtimes, key=mtimes.get)
+        for f in files[:len(files) - self.max_entries]:
+            with contextlib.suppress(OSError):
+                os.remove(f)
+
+    @staticmethod
+    def conditional_headers(entry):
+        # revalidate a stale entry instead of downloading it again, if the server supports it
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
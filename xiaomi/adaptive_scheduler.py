@@ -0,0 +1,102 @@
+import os
+import json
+import time
+
+# a reading is "moving" when it changes by about one step per interval,
+# the interval is chosen so that every poll sees roughly one step of change
+TEMPERATURE_STEP = float(os.getenv('ADAPTIVE_TEMPERATURE_STEP', 0.2))
+HUMIDITY_STEP = float(os.getenv('ADAPTIVE_HUMIDITY_STEP', 2))
+# minutes between polls
+MIN_INTERVAL = float(os.getenv('ADAPTIVE_MIN_INTERVAL', 5))
+MAX_INTERVAL = float(os.getenv('ADAPTIVE_MAX_INTERVAL', 60))
+# sensors with a weak battery are polled at most this often
+LOW_BATTERY = float(os.getenv('ADAPTIVE_LOW_BATTERY', 2.7))
+LOW_BATTERY_INTERVAL = float(os.getenv('ADAPTIVE_LOW_BATTERY_INTERVAL', 30))
+# after BUSY_LIMIT busy answers in a row a sensor is skipped for BUSY_COOLDOWN minutes
+BUSY_LIMIT = int(os.getenv('ADAPTIVE_BUSY_LIMIT', 3))
+BUSY_COOLDOWN = float(os.getenv('ADAPTIVE_BUSY_COOLDOWN', 30))
+# weight of the newest rate of change, older ones fade out so a single jump doesn't dominate
+SMOOTHING = 0.5
+# cron starts the script every minute, a sensor that is due within this many seconds is polled now
+SLACK = 30
+
+class AdaptiveScheduler:
+    # keeps per sensor when it was polled, its last values and the smoothed rate of change
+    # in a json file, so it works the same when started by cron every minute or by the daemon
+    def __init__(self, path, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.state = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            print('Ignoring broken schedule state {}'.format(self.path))
+            return {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def due(self, names, now=None):
+        # names of the sensors that should be polled now, unknown sensors are always due
+        now = now or time.time()
+        due = []
+        for name in names:
+            sensor = self.state.get(name)
+            if sensor is None:
+                due.append(name)
+            elif now < sensor.get('cooldown_until', 0):
+                continue
+            elif now >= sensor['next_poll'] - SLACK:
+                due.append(name)
+        return due
+
+    def record(self, name, reading=None, busy=False, now=None):
+        # update the schedule of a sensor with the result of a poll, reading is None if it failed
+        now = now or time.time()
+        sensor = self.state.setdefault(name, {'interval': self.min_interval, 'rate': None, 'busy': 0})
+        if busy:
+            sensor['busy'] += 1
+            if sensor['busy'] >= BUSY_LIMIT:
+                print('[{}] Busy {} times in a row, skipping it for {} minutes'.format(name, sensor['busy'], BUSY_COOLDOWN))
+                sensor['cooldown_until'] = now + BUSY_COOLDOWN * 60
+                sensor['busy'] = 0
+            sensor['next_poll'] = now + self.min_interval * 60
+            return sensor
+        sensor['busy'] = 0
+        sensor.pop('cooldown_until', None)
+        if reading is None:
+            # try again soon, the interval stays what the values asked for
+            sensor['next_poll'] = now + self.min_interval * 60
+            return sensor
+        if 'time' in sensor:
+            minutes = max((now - sensor['time']) / 60, 1e-3)
+            # changes in steps per minute, the faster of temperature and humidity counts
+            rate = max(abs(reading.temperature - sensor['temperature']) / TEMPERATURE_STEP,
+                       abs(reading.humidity - sensor['humidity']) / HUMIDITY_STEP) / minutes
+            sensor['rate'] = rate if sensor['rate'] is None else SMOOTHING * rate + (1 - SMOOTHING) * sensor['rate']
+        sensor['interval'] = self.interval(sensor['rate'], reading.battery)
+        sensor.update(time=now, temperature=reading.temperature, humidity=reading.humidity, battery=reading.battery)
+        sensor['next_poll'] = now + sensor['interval'] * 60
+        return sensor
+
+    def interval(self, rate, battery):
+        # minutes until the values are expected to have changed by one step
+        if rate is None:
+            interval = self.min_interval
+        elif rate <= 0:
+            interval = self.max_interval
+        else:
+            interval = min(self.max_interval, max(self.min_interval, 1 / rate))
+        if battery < LOW_BATTERY:
+            interval = max(interval, min(LOW_BATTERY_INTERVAL, self.max_interval))
+        return round(interval, 1)
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import glob
+import gzip
+import time
+import argparse
+from datetime import datetime
+
+from read_Mi_Temp_Humid import BASEPATH, SensorReading
+sys.path.insert(0, os.path.join(BASEPATH, '..'))
+from common.influx_writer import InfluxWriter
+from common.influx_client import client_from_env
+
+CSV_PATH = os.path.join(BASEPATH, '../data/temperature.csv')
+# rotated files (temperature.<date>.csv[.gz]) sort before the live file
+CSV_FILES = os.path.join(BASEPATH, '../data/temperature*.csv*')
+CHUNK_SIZE = 10000
+
+def parse_line(line):
+    # '2023-01-01T12:00:00, Livingroom, 21.5°C, 45%, 2.95V' as written by SensorReading.write_to_file
+    timestamp, location, temperature, humidity, battery = line.rstrip('\r\n').split(', ')
+    reading = SensorReading(location, temperature.rstrip('°C'), humidity.rstrip('%'), battery.rstrip('V'))
+    reading.timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+    return reading
+
+def open_csv(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def first_line(path):
+    # identifies the file, the live file starts over after it has been rotated
+    with open_csv(path) as f:
+        f.readline()
+        return f.readline().decode('utf-8').strip()
+
+def read_rows(path, offset=0):
+    # yields (offset after the line, reading or None) without loading the whole file
+    with open_csv(path) as f:
+        f.seek(offset)
+        for line in iter(f.readline, b''):
+            if not line.endswith(b'\n'):
+                # the collector's buffered sink hasn't written the rest of the line yet,
+                # the next run starts at the beginning of it
+                break
+            line = line.decode('utf-8')
+            if line.startswith('timestamp') or not line.strip():
+                reading = None
+            else:
+                try:
+                    reading = parse_line(line)
+                except ValueError:
+                    print('Skipping unparseable line: {}'.format(line.strip()))
+                    reading = None
+            yield f.tell(), reading
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {'offset': 0, 'written': 0, 'skipped': 0}
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def backfill(path=CSV_PATH, chunk_size=CHUNK_SIZE, checkpoint_path=None, dry_run=False):
+    # writes the csv history to temp_sensor in chunks, the offset of the last written chunk
+    # is kept in the checkpoint file so an interrupted import continues where it stopped
+    checkpoint_path = checkpoint_path or path + '.backfill'
+    checkpoint = load_checkpoint(checkpoint_path)
+    head = first_line(path)
+    if checkpoint.get('head', head) != head:
+        print('{} has been rotated since the last import, starting at the beginning'.format(path))
+        checkpoint = {'offset': 0, 'written': 0, 'skipped': 0}
+    checkpoint['head'] = head
+    if checkpoint['offset']:
+        print('Resuming {} at byte {} ({} points written so far)'.format(path, checkpoint['offset'], checkpoint['written']))
+    writer = InfluxWriter(client_from_env, rejected_path=path + '.rejected')
+    start = time.monotonic()
+    written = 0
+    total_skipped = 0
+
+    def commit(lines, offset, skipped):
+        nonlocal written, total_skipped
+        total_skipped += skipped
+        if not dry_run:
+            if lines and not writer.write_batch(lines):
+                print('Stopped, run again to resume at byte {}'.format(checkpoint['offset']))
+                return False
+            checkpoint['offset'] = offset
+            checkpoint['written'] += len(lines)
+            checkpoint['skipped'] += skipped
+            save_checkpoint(checkpoint_path, checkpoint)
+        written += len(lines)
+        print('{} points written ({:.0f} points/s)'.format(written, written / max(time.monotonic() - start, 1e-6)))
+        return True
+
+    lines = []
+    skipped = 0
+    offset = checkpoint['offset']
+    for offset, reading in read_rows(path, checkpoint['offset']):
+        if reading is None:
+            continue
+        if not reading.is_valid():
+            skipped += 1
+            continue
+        lines.append(reading.to_line())
+        if len(lines) >= chunk_size:
+            if not commit(lines, offset, skipped):
+                return False
+            lines = []
+            skipped = 0
+    if not commit(lines, offset, skipped):
+        return False
+    print('Done: {} points written, {} invalid readings skipped in {:.1f}s'.format(
+        written, total_skipped, time.monotonic() - start))
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import the readings from temperature.csv into influxdb')
+    parser.add_argument('paths', nargs='*', help='csv files written by read_Mi_Temp_Humid.py, default: data/temperature*.csv*')
+    parser.add_argument('-c', '--chunk-size', type=int, default=CHUNK_SIZE, help='points per write')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoints and import from the beginning')
+    parser.add_argument('--dry-run', action='store_true', help="parse and validate only, don't write to influxdb")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(p for p in glob.glob(CSV_FILES) if not p.endswith(('.backfill', '.tmp')))
+    for path in paths:
+        checkpoint_path = path + '.backfill'
+        if args.restart and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        print('Importing {}'.format(path))
+        if not backfill(path, args.chunk_size, checkpoint_path, args.dry_run):
+            sys.exit(1)
@@ -0,0 +1,86 @@
+import os
+import gzip
+import shutil
+import threading
+from datetime import datetime
+
+BUFFER_SIZE = 64 * 1024
+MAX_BYTES = 10 * 1024 * 1024
+
+class RotatingCsvSink:
+    # keeps one buffered handle open for the whole run and rotates the file by day or size.
+    # rotated files are renamed to <name>.<date>.csv and optionally gzipped
+    def __init__(self, path, header, rotate='day', max_bytes=MAX_BYTES, compress=False, buffer_size=BUFFER_SIZE):
+        if rotate not in ('day', 'size', None):
+            raise ValueError('rotate must be day, size or None, not {}'.format(rotate))
+        self.path = path
+        self.header = header
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.file = None
+        self.day = None
+        self.size = 0
+
+    def write(self, line, now=None):
+        now = now or datetime.now()
+        with self.lock:
+            if self.file is None:
+                self._open(now)
+            if self._needs_rotation(now):
+                self._rotate(now)
+            data = line + '\n'
+            self.file.write(data)
+            self.size += len(data.encode('utf-8'))
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _open(self, now):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        exists = os.path.exists(self.path)
+        if exists:
+            # an existing file belongs to the day it was last written
+            self.day = datetime.fromtimestamp(os.path.getmtime(self.path)).date()
+            self.size = os.path.getsize(self.path)
+        else:
+            self.day = now.date()
+            self.size = 0
+        self.file = open(self.path, 'a', buffering=self.buffer_size)
+        if not exists:
+            self.file.write(self.header + '\n')
+            self.size += len(self.header) + 1
+
+    def _needs_rotation(self, now):
+        if self.rotate == 'day':
+            return now.date() != self.day
+        if self.rotate == 'size':
+            return self.size >= self.max_bytes
+        return False
+
+    def _rotate(self, now):
+        self.file.close()
+        suffix = self.day.isoformat() if self.rotate == 'day' else now.strftime('%Y-%m-%dT%H%M%S')
+        base, ext = os.path.splitext(self.path)
+        target = '{}.{}{}'.format(base, suffix, ext)
+        counter = 1
+        while os.path.exists(target) or os.path.exists(target + '.gz'):
+            target = '{}.{}.{}{}'.format(base, suffix, counter, ext)
+            counter += 1
+        os.rename(self.path, target)
+        if self.compress:
+            with open(target, 'rb') as src, gzip.open(target + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(target)
+        self.file = None
+        self._open(now)
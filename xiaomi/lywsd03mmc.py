@@ -0,0 +1,134 @@
+import argparse
+import json
+import re
+import struct
+import subprocess
+import threading
+
+# bluepy talks to the adapter directly, without it we fall back to a single gatttool process.
+# it is only imported by the first read, the shell script sensors never need it.
+# set btle = None to always use gatttool
+_NOT_IMPORTED = object()
+btle = _NOT_IMPORTED
+_NotificationDelegate = None
+_BTLE_LOCK = threading.Lock()
+
+# writing 0100 to this handle makes the sensor send one notification with its current reading
+NOTIFY_HANDLE = 0x0038
+NOTIFY_VALUE = b'\x01\x00'
+TIMEOUT = 15
+
+NOTIFICATION_PATTERN = re.compile(r'Notification handle = 0x[0-9a-fA-F]+ value: ((?:[0-9a-fA-F]{2}\s*)+)')
+
+class ReadingFailed(Exception):
+    pass
+
+class SensorBusy(Exception):
+    pass
+
+def decode_payload(payload: bytes):
+    # LYWSD03MMC notification: temperature in 1/100 °C (int16, little endian),
+    # humidity in % (uint8), battery voltage in mV (uint16, little endian)
+    if len(payload) < 5:
+        raise ReadingFailed('payload too short: {}'.format(payload.hex()))
+    temperature, humidity, battery = struct.unpack_from('<hBH', payload)
+    return temperature / 100, humidity, battery / 1000
+
+def decode_hex(value: str):
+    # decode a hex dump like '58 08 2d 5f 0b' as printed by gatttool
+    try:
+        return decode_payload(bytes.fromhex(value))
+    except ValueError as e:
+        raise ReadingFailed('invalid hex dump {}: {}'.format(value, e))
+
+def parse_gatttool_output(output: str):
+    if 'busy' in output:
+        raise SensorBusy(output.strip())
+    match = NOTIFICATION_PATTERN.search(output)
+    if match is None:
+        raise ReadingFailed('no notification received')
+    return decode_hex(match.group(1))
+
+def read_gatttool(mac, timeout=TIMEOUT):
+    cmd = ['gatttool', '-b', mac, '--char-write-req', '--handle={:#06x}'.format(NOTIFY_HANDLE),
+           '--value={}'.format(NOTIFY_VALUE.hex()), '--listen']
+    output = []
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
+        # gatttool keeps listening forever, stop it after the first notification or the timeout
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            for line in proc.stdout:
+                line = line.decode('utf-8', errors='replace')
+                output.append(line)
+                if NOTIFICATION_PATTERN.search(line):
+                    break
+        finally:
+            timer.cancel()
+            proc.kill()
+    return parse_gatttool_output(''.join(output))
+
+def import_btle():
+    # returns bluepy.btle or None if it isn't installed, the first caller imports it
+    global btle, _NotificationDelegate
+    with _BTLE_LOCK:
+        if btle is not _NOT_IMPORTED:
+            return btle
+        try:
+            from bluepy import btle as module
+        except ImportError:
+            btle = None
+            return None
+
+        class NotificationDelegate(module.DefaultDelegate):
+            def __init__(self):
+                super().__init__()
+                self.payload = None
+
+            def handleNotification(self, cHandle, data):
+                self.payload = data
+
+        _NotificationDelegate = NotificationDelegate
+        btle = module
+        return btle
+
+def read_bluepy(mac, timeout=TIMEOUT):
+    delegate = _NotificationDelegate()
+    try:
+        peripheral = btle.Peripheral(mac)
+    except btle.BTLEException as e:
+        if 'busy' in str(e).lower():
+            raise SensorBusy(str(e))
+        raise ReadingFailed(str(e))
+    try:
+        peripheral.withDelegate(delegate)
+        peripheral.writeCharacteristic(NOTIFY_HANDLE, NOTIFY_VALUE, withResponse=True)
+        peripheral.waitForNotifications(timeout)
+    except btle.BTLEException as e:
+        raise ReadingFailed(str(e))
+    finally:
+        peripheral.disconnect()
+    if delegate.payload is None:
+        raise ReadingFailed('no notification received')
+    return decode_payload(delegate.payload)
+
+def read_sensor(mac, timeout=TIMEOUT):
+    # returns (temperature, humidity, battery)
+    if import_btle() is not None:
+        return read_bluepy(mac, timeout)
+    return read_gatttool(mac, timeout)
+
+def load_sensors(path):
+    # sensors.json: [{"name": "Livingroom", "mac": "A4:C1:38:XX:XX:XX"}, ...]
+    with open(path) as f:
+        sensors = json.load(f)
+    for sensor in sensors:
+        if 'name' not in sensor or 'mac' not in sensor:
+            raise ValueError('sensor config needs a name and a mac: {}'.format(sensor))
+    return sensors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode LYWSD03MMC notifications')
+    parser.add_argument('value', nargs='+', help='hex dump of a notification, e.g. "58 08 2d 5f 0b"')
+    args = parser.parse_args()
+    print('{}°C, {}%, {}V'.format(*decode_hex(' '.join(args.value))))
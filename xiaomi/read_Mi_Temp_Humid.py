@@ -1,61 +1,183 @@
 import os
 import time
 from datetime import datetime, timezone
+import sys
 import glob
+import fcntl
 import subprocess
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import dotenv
-from influxdb import InfluxDBClient
+
+import lywsd03mmc
+from csv_sink import RotatingCsvSink
+from adaptive_scheduler import AdaptiveScheduler
 
 BASEPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASEPATH, '..'))
+from common.influx_writer import InfluxWriter
+from common.influx_client import client_from_env
+from common.collector_stats import CollectorStats
+from common.line_protocol import PointSchema
 
 url="http://localhost:8086"
 
 env = dotenv.load_dotenv()
 
-CLIENT = InfluxDBClient(host=os.getenv('INFLUXDB_HOST'),
-                        port=os.getenv('INFLUXDB_PORT'),
-                        username=os.getenv('INFLUXDB_USER'),
-                        password=os.getenv('INFLUXDB_PASSWORD'),
-                        database=os.getenv('INFLUXDB_DATABASE'))
+# durations, retries and failures of a run, written as collector_stats after the readings
+STATS = CollectorStats('xiaomi')
+
+# points are written in one batch at the end of the run, or spooled if influxdb is down.
+# the influxdb client is only created for that write
+WRITER = InfluxWriter(client_from_env, spool_path=os.path.join(BASEPATH, '../data/xiaomi_spool.lp'), stats=STATS)
+
+SENSOR_CONFIG = os.path.join(BASEPATH, 'sensors/sensors.json')
+# with --adaptive the script runs every minute and only polls the sensors that are due
+SCHEDULE_STATE = os.path.join(BASEPATH, '../data/xiaomi_schedule.json')
+# a run that takes longer than a minute must not overlap with the next one
+RUN_LOCK = os.path.join(BASEPATH, '../data/xiaomi.lock')
+
+# the bluetooth adapter can only keep a few connections open at once
+MAX_CONNECTIONS = int(os.getenv('MAX_BLE_CONNECTIONS', 3))
+
+# readings are appended to one buffered file that is rotated daily (CSV_ROTATE=day|size|none),
+# rotated files can be gzipped with CSV_COMPRESS=1
+SINK = RotatingCsvSink(os.path.join(BASEPATH, '../data/temperature.csv'),
+                       'timestamp, location, temperature, humidity, battery',
+                       rotate=None if os.getenv('CSV_ROTATE', 'day') == 'none' else os.getenv('CSV_ROTATE', 'day'),
+                       max_bytes=int(os.getenv('CSV_MAX_BYTES', 10 * 1024 * 1024)),
+                       compress=os.getenv('CSV_COMPRESS') == '1')
+
+def find_sensors():
+    # sensors from sensors.json are read in-process, copied shell scripts are still supported
+    sensors = []
+    if os.path.exists(SENSOR_CONFIG):
+        sensors += lywsd03mmc.load_sensors(SENSOR_CONFIG)
+    sensors += [x.split('/')[-1] for x in glob.glob(BASEPATH + '/sensors/*Mi_Temp_Humid_*.sh')]
+    return sensors
+
+def sensor_name(sensor):
+    # sensors are either configs from sensors.json or the name of a legacy shell script
+    return sensor['name'] if isinstance(sensor, dict) else sensor
+
+def read_script(sensor):
+    # legacy path: run the copied TEMPLATE_get_Mi_Temp_Humid.sh and parse its output
+    proc = subprocess.run(['sh', '{}/sensors/./{}'.format(BASEPATH, sensor)], stdout=subprocess.PIPE)
+    line = proc.stdout.decode('utf-8').strip()
+    if 'busy' in line:
+        raise lywsd03mmc.SensorBusy(line)
+    if not line or 'reading failed' in line or 'error' in line:
+        raise lywsd03mmc.ReadingFailed(line)
+    try:
+        l, t, h, b = line.split(', ')
+    except ValueError:
+        raise lywsd03mmc.ReadingFailed('Something went wrong parsing line {}'.format(line))
+    return l, t, h, b
+
+def read_reading(sensor):
+    if isinstance(sensor, dict):
+        t, h, b = lywsd03mmc.read_sensor(sensor['mac'])
+        return sensor['name'], t, h, b
+    return read_script(sensor)
 
 def get_temperature(sensor):
     # Get temperature from sensor
-    success = False
+    name = sensor_name(sensor)
     retries = 0
-    while not success:
-        with subprocess.Popen(['sh', '{}/sensors/./{}'.format(BASEPATH, sensor)], stdout=subprocess.PIPE) as proc:
-            while True:
-                line = proc.stdout.readline().decode('utf-8').rstrip()
-                if not line:
-                    break
-                if 'reading failed' in line or 'error' in line:
-                    print('current retries: {}'.format(retries))
-                    if retries >= 3:
-                        print('Too many retries - giving up')
-                        return
-                    else:
-                        retries += 1
-                        print('Retrying, backing off for {} seconds'.format(2**retries))
-                        time.sleep(1*2**retries)
-                        break
-                if  'busy' in line:
-                    return
-                else:
-                    try:
-                        l, t, h, b = line.rstrip().split(', ')
-                    except Exception as e:
-                        print('Something went wrong parsing line {} trying again.'.format(line))
-                        break
-
-                    # create object
-                    output = SensorReading(l, t, h, b)
-                    print('Got data: {}'.format(output))
-                    if output.is_valid():
-                        output.write_to_file()
-                        output.write_to_influxdb()
-                        success = True
+    while True:
+        try:
+            with STATS.timer('read'):
+                output = SensorReading(*read_reading(sensor))
+            print('Got data: {}'.format(output))
+            if output.is_valid():
+                output.write_to_file()
+                output.write_to_influxdb()
+                STATS.count('readings')
+                return output
+            STATS.count('invalid_readings')
+            error = 'invalid reading {}'.format(output)
+        except lywsd03mmc.SensorBusy:
+            print('[{}] Sensor is busy'.format(name))
+            STATS.count('busy')
+            raise
+        except lywsd03mmc.ReadingFailed as e:
+            error = e
+        print('[{}] Reading failed: {}, current retries: {}'.format(name, error, retries))
+        if retries >= 3:
+            print('[{}] Too many retries - giving up'.format(name))
+            STATS.count('failed_sensors')
+            return None
+        retries += 1
+        STATS.count('retries')
+        print('[{}] Retrying, backing off for {} seconds'.format(name, 2**retries))
+        with STATS.timer('backoff'):
+            time.sleep(1*2**retries)
+
+def poll_sensor(sensor):
+    # read a single sensor and time it, never raises so one sensor can't break the run
+    start = time.monotonic()
+    busy = False
+    try:
+        reading = get_temperature(sensor)
+    except lywsd03mmc.SensorBusy:
+        reading = None
+        busy = True
+    except Exception as e:
+        print('[{}] Error: {}'.format(sensor_name(sensor), e))
+        reading = None
+    return sensor_name(sensor), reading, time.monotonic() - start, busy
+
+@STATS.timed('poll')
+def poll_sensors(sensors, max_connections=MAX_CONNECTIONS):
+    # poll all sensors concurrently, at most max_connections BLE connections at a time.
+    # each sensor backs off in its own worker so a retrying sensor doesn't block the others
+    start = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, max_connections)) as executor:
+        futures = [executor.submit(poll_sensor, sensor) for sensor in sensors]
+        for future in as_completed(futures):
+            sensor, reading, duration, busy = future.result()
+            status = 'ok' if reading is not None else 'busy' if busy else 'failed'
+            print('[{}] {} after {:.1f}s'.format(sensor, status, duration))
+            results.append((sensor, reading, duration, busy))
+    total = time.monotonic() - start
+    succeeded = sum(1 for _, reading, _, _ in results if reading is not None)
+    slowest = max((duration for _, _, duration, _ in results), default=0)
+    print('Polled {} sensors in {:.1f}s ({} ok, {} failed, slowest {:.1f}s)'.format(
+        len(results), total, succeeded, len(results) - succeeded, slowest))
+    SINK.flush()
+    return results
+
+def poll_adaptive(sensors, max_connections=MAX_CONNECTIONS, state_path=SCHEDULE_STATE):
+    # poll only the sensors whose interval is over. sensors with changing values are polled
+    # more often, flat ones and ones with a weak battery less often, busy ones get a cooldown
+    scheduler = AdaptiveScheduler(state_path)
+    due = set(scheduler.due([sensor_name(sensor) for sensor in sensors]))
+    if not due:
+        print('No sensor is due')
+        return []
+    results = poll_sensors([sensor for sensor in sensors if sensor_name(sensor) in due], max_connections)
+    for name, reading, _, busy in results:
+        sensor = scheduler.record(name, reading, busy)
+        print('[{}] next poll in {:.0f} minutes'.format(name, (sensor['next_poll'] - time.time()) / 60))
+    scheduler.save()
+    return results
+
+def lock_run(path=RUN_LOCK):
+    # returns the locked file, keep it open until the run is done. None if another run holds it
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    f = open(path, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
 
 class SensorReading:
+    __slots__ = ('timestamp', 'location', 'temperature', 'humidity', 'battery')
+    SCHEMA = PointSchema('temp_sensor', ('location',), ('temperature', 'humidity', 'battery'))
+
     def __init__(self, location, temperature, humidity, battery):
         self.timestamp = datetime.now()
         self.location = str(location)
@@ -66,30 +188,31 @@ class SensorReading:
     def __str__(self):
         return '{}, {}, {}°C, {}%, {}V'.format(self.timestamp.strftime('%Y-%m-%dT%H:%M:%S'), self.location, self.temperature, self.humidity, self.battery)
     
-    def write_to_file(self):
-        path = os.path.join(BASEPATH, '../data/temperature.csv')
-        if not os.path.exists(path):
-            with open(path, 'w') as f:
-                f.write('timestamp, location, temperature, humidity, battery\n')
-        with open(path, 'a') as f:
-            f.write('{}\n'.format(self))
+    def write_to_file(self, sink=None):
+        with STATS.timer('csv_write'):
+            (sink or SINK).write(str(self), self.timestamp)
     
-    def write_to_influxdb(self):
-        data = [
-            {
-                'measurement': 'temp_sensor',
-                'tags': {
-                    'location': self.location
-                },
-                'time': self.timestamp,
-                'fields': {
-                    'temperature': self.temperature,
-                    'humidity': self.humidity,
-                    'battery': self.battery
-                }
+    def to_point(self):
+        return {
+            'measurement': 'temp_sensor',
+            'tags': {
+                'location': self.location
+            },
+            'time': self.timestamp,
+            'fields': {
+                'temperature': self.temperature,
+                'humidity': self.humidity,
+                'battery': self.battery
             }
-        ]
-        CLIENT.write_points(data)
+        }
+
+    def to_line(self):
+        return self.SCHEMA.encode((self.location,), (self.temperature, self.humidity, self.battery), self.timestamp)
+
+    def write_to_influxdb(self, writer=None):
+        with STATS.timer('encode'):
+            line = self.to_line()
+        (writer or WRITER).add_lines([line])
 
     def is_valid(self):
         if self.temperature > 60 or self.temperature < -10:
@@ -101,6 +224,26 @@ class SensorReading:
         return True
 
 if __name__ == "__main__":
-    sensors = [x.split('/')[-1] for x in glob.glob(BASEPATH + '/sensors/*Mi_Temp_Humid_*.sh')]
-    for sensor in sensors:
-        get_temperature(sensor)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Read Xiaomi Mi temperature and humidity sensors and write the data to influxdb')
+    parser.add_argument('-j', '--max-connections', type=int, default=MAX_CONNECTIONS, help='maximum number of sensors to poll at the same time')
+    parser.add_argument('-s', '--sequential', action='store_true', help='poll the sensors one after another')
+    parser.add_argument('-a', '--adaptive', action='store_true', help='only poll the sensors that are due, run this every minute')
+    parser.add_argument('--profile-startup', action='store_true', help='show what the imports of this script cost and exit')
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        from common import startup_profile
+        startup_profile.report('read_Mi_Temp_Humid', BASEPATH, ['influxdb', 'bluepy.btle'])
+        sys.exit(0)
+
+    max_connections = 1 if args.sequential else args.max_connections
+    if args.adaptive:
+        run_lock = lock_run()
+        if run_lock is None:
+            print('Another run is still polling, exiting')
+            sys.exit(0)
+        poll_adaptive(find_sensors(), max_connections)
+    else:
+        poll_sensors(find_sensors(), max_connections)
+    SINK.close()
+    WRITER.flush_with_stats(STATS)
\ No newline at end of file